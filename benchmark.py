@@ -0,0 +1,295 @@
+import argparse
+import os
+import tempfile
+import time
+
+from helpers.utils import (
+    check_dirs_exist,
+    get_device,
+    set_seeds,
+    load_model,
+    BufferLogger,
+    Logger
+)
+import models
+from helpers.container import DirectoryStore
+from helpers.encoder import HuffmanEncoder
+from helpers.exporter import SharedExporter
+from helpers.pruner import FiltersPruner
+from helpers.quantizer import PostQuantizer
+from helpers.scorer import get_exact_gm_dists, get_pairwise_gm_dists, get_approx_gm_dists, get_prune_indices
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+parser = argparse.ArgumentParser(description='Micro Benchmarks')
+parser.add_argument('--task', type=str, default='mask-grad')
+parser.add_argument('--models', type=str, nargs='+', default=['resnet56', 'resnet50'])
+parser.add_argument('--n-iters', type=int, default=100)
+parser.add_argument('--seed', type=int, default=111)
+parser.add_argument('--dev-idx', type=int, default=0)
+parser.add_argument('--layer-shapes', type=int, nargs='+', default=[64, 576, 256, 2304, 512, 4608, 1024, 9216,
+                                                                    2048, 4608])  # (n_f, n_c * h * w) pairs
+parser.add_argument('--prune-rate', type=float, default=0.6)
+parser.add_argument('--gm-eps', type=float, default=0.3)
+parser.add_argument('--n-symbols', type=int, nargs='+', default=[100000, 1000000])  # Sizes of the Huffman benchmarks
+parser.add_argument('--n-values', type=int, default=16)  # Number of distinct values (quantized weights)
+parser.add_argument('--zero-rate', type=float, default=0.5)  # Share of the zero (pruned) weights
+parser.add_argument('--load-paths', type=str, nargs='+', default=None)  # Quantized models of "quantize_encode.py"
+parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 32])  # Inference benchmarks (32 x 32 inputs)
+parser.add_argument('--log-name', type=str, default='BENCHMARK.txt')
+args = parser.parse_args()
+
+os.environ['KMP_DUPLICATE_LIB_OK'] = 'True'  # For Mac OS
+args.log_path = f'saves/{args.log_name}'
+
+
+def get_time_per_iter(fn, n_iters, device):
+    fn()  # Warm up
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    t0 = time.perf_counter()
+    for _ in range(n_iters):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - t0) / n_iters
+
+
+def get_nbytes(tensors):
+    return sum(t.nelement() * t.element_size() for t in tensors)
+
+
+def bench_mask_grad(model_name, device, logger):
+    """ Per-step overhead of masking the gradients of the pruned filters """
+    model = models.__dict__[model_name]().to(device)
+    pruner = FiltersPruner(model, None, None, logger, device=device)
+    pruner.prune('filter-a', [0.6])
+    for p in model.parameters():
+        p.grad = torch.randn_like(p)
+
+    # The previous implementation : walk the modules and multiply dense masks
+    conv_mask = pruner.get_conv_mask()
+
+    def dense_loop():
+        for name, module in model.named_modules():
+            if name in conv_mask:
+                grad = module.weight.grad
+                grad.data *= conv_mask[name]
+
+    weights, factors = pruner.get_grad_masks()
+
+    def compact_foreach():
+        FiltersPruner.mask_grads(weights, factors)
+
+    t_dense = get_time_per_iter(dense_loop, args.n_iters, device)
+    t_compact = get_time_per_iter(compact_foreach, args.n_iters, device)
+    logger.log(
+        f'{model_name:10} | dense loop : {t_dense * 1e6:10.1f} us/step ({get_nbytes(conv_mask.values()):>10} mask bytes) '
+        f'| compact foreach : {t_compact * 1e6:10.1f} us/step ({get_nbytes(factors):>8} mask bytes) '
+        f'| {t_dense / t_compact:6.2f}x', verbose=True
+    )
+
+
+def bench_quan_grad(model_name, device, logger):
+    """ Per-step overhead of sharing the gradients of the quantized (weight-shared) layers """
+    model, quan_dict = get_quantized_model(model_name, None, logger)
+    model = model.to(device)
+    for p in model.parameters():
+        p.grad = torch.randn_like(p)
+
+    # The previous implementation : copy to numpy, one masked sum per cluster, copy back
+    masks = {name: (np.where(quan_dict[name] == -1, 0, 1), [np.where(quan_dict[name] == i)
+                                                             for i in range(len(np.unique(quan_dict[name])))])
+             for name in quan_dict}
+
+    def numpy_loop():
+        for name, module in model.named_modules():
+            if name in quan_dict:
+                grad = module.weight.grad.data.cpu().numpy()
+                grad *= masks[name][0]
+                for group_ind in masks[name][1]:
+                    grad[group_ind] = np.sum(grad[group_ind])
+                module.weight.grad.data = torch.from_numpy(grad).to(device)
+
+    groups = PostQuantizer.get_grad_groups(model, quan_dict)
+
+    def on_device():
+        PostQuantizer.share_grads(groups)
+
+    t_numpy = get_time_per_iter(numpy_loop, args.n_iters, device)
+    t_device = get_time_per_iter(on_device, args.n_iters, device)
+    logger.log(f'{model_name:10} | numpy loop : {t_numpy * 1e3:10.2f} ms/step '
+               f'| on device : {t_device * 1e3:10.2f} ms/step | {t_numpy / t_device:6.2f}x', verbose=True)
+
+
+def bench_gm_approx(n_f, d, device, logger):
+    """ Speedup and agreement with the pruned filters of the pairwise GM distances """
+    w = torch.randn(1, n_f, d, device=device) * torch.rand(1, n_f, 1, device=device)  # Spread filter norms
+    n_prune = int(round(n_f * (1.0 - args.prune_rate)))
+    pairwise = set(get_prune_indices(get_pairwise_gm_dists(w), [n_prune])[0])
+    t_pairwise = get_time_per_iter(lambda: get_pairwise_gm_dists(w), args.n_iters, device)
+    text = f'({n_f:5}, {d:5}) | pairwise : {t_pairwise * 1e3:9.3f} ms'
+    for method in ['exact', 'sketch']:
+        def fn():
+            if method == 'exact':
+                return get_exact_gm_dists(w)
+            return get_approx_gm_dists(w, method=method, eps=args.gm_eps)
+        approx = set(get_prune_indices(fn(), [n_prune])[0])
+        t = get_time_per_iter(fn, args.n_iters, device)
+        text += (f' | {method} : {t * 1e3:9.3f} ms ({t_pairwise / t:7.2f}x, '
+                 f'agreement {100 * len(pairwise & approx) / max(n_prune, 1):6.2f}%)')
+    logger.log(text, verbose=True)
+
+
+def get_quantized_weights(n_symbols):
+    """ Weights taking "n_values" values, "zero_rate" of them are 0 """
+    centroids = np.random.randn(args.n_values - 1).astype(np.float32)
+    arr = centroids[np.random.randint(0, args.n_values - 1, size=n_symbols)]
+    arr[np.random.rand(n_symbols) < args.zero_rate] = 0.
+    return arr
+
+
+def bench_huffman_decode(n_symbols, logger):
+    """ Throughput of the table driven Huffman decoders against the former bit string decoder """
+    arr = get_quantized_weights(n_symbols)
+    cpu = torch.device('cpu')
+    text = f'{n_symbols:>10} symbols'
+    with tempfile.TemporaryDirectory() as directory:
+        store = DirectoryStore(directory)
+        out = np.empty_like(arr)
+        t_bitstr = None
+        for codebook in ['tree', 'canonical']:
+            encoder = HuffmanEncoder(logger, canonical=codebook == 'canonical')
+            codebook_size = encoder._huffman_encode(arr, codebook, store)[0]
+            assert np.array_equal(encoder._huffman_decode(store, codebook, 'float32', out=out), arr)
+            if t_bitstr is None:
+                t_bitstr = get_time_per_iter(lambda: encoder._huffman_decode_bitstr(directory, codebook, 'float32'),
+                                             args.n_iters, cpu)
+                text += f' | bit string : {n_symbols / t_bitstr:14,.0f} symbols/s'
+            t = get_time_per_iter(lambda: encoder._huffman_decode(store, codebook, 'float32', out=out),
+                                  args.n_iters, cpu)
+            text += (f' | {codebook} table : {n_symbols / t:14,.0f} symbols/s ({t_bitstr / t:7.2f}x, '
+                     f'codebook {codebook_size} bytes)')
+    logger.log(text, verbose=True)
+
+
+def get_quantized_model(model_name, load_path, logger):
+    """
+    A quantized model saved by "quantize_encode.py", or a model whose conv / linear weights are pruned by magnitude
+    ("zero_rate") and rounded to "n_values" levels, with the cluster indices of its weights
+    """
+    model = models.__dict__[model_name]()
+    if load_path is not None:
+        load_model(model, load_path, logger, device='cpu')
+    quan_dict = dict()
+    for name, module in model.named_modules():
+        if not isinstance(module, (nn.Conv2d, nn.Linear)):
+            continue
+        w = module.weight.data.numpy()
+        if load_path is None:
+            w = np.where(np.abs(w) < np.quantile(np.abs(w), args.zero_rate), 0., w)
+            levels = np.linspace(np.min(w), np.max(w), args.n_values - 1)
+            w = np.where(w == 0, 0., levels[np.argmin(np.abs(w[..., None] - levels), axis=-1)]).astype(np.float32)
+            module.weight.data = torch.from_numpy(w)
+        centroids, labels = np.unique(w, return_inverse=True)
+        if len(centroids) <= 1 << 8:  # Quantized
+            quan_dict[name] = np.where(w == 0, -1, labels.reshape(w.shape))
+    return model, quan_dict
+
+
+def bench_entropy_coders(model_name, load_path, logger):
+    """ Compression ratio and encode / decode throughput of every entropy coder on a quantized model """
+    model, quan_dict = get_quantized_model(model_name, load_path, logger)
+    original = sum(t.nelement() * t.element_size() for t in model.state_dict().values())
+    cpu = torch.device('cpu')
+    for coders in [('huffman',), ('rans',), ('huffman', 'rans')]:
+        encoder = HuffmanEncoder(BufferLogger(), coders=coders)  # Without the per-layer logs
+        with tempfile.TemporaryDirectory() as directory:
+            t_enc = get_time_per_iter(lambda: encoder.huffman_encode_model(model, directory, 'container', quan_dict),
+                                      args.n_iters, cpu)
+            compressed = os.path.getsize(os.path.join(directory, HuffmanEncoder.CONTAINER_NAME))
+            t_dec = get_time_per_iter(lambda: encoder.huffman_decode_model(model, directory, 'container'),
+                                      args.n_iters, cpu)
+        logger.log(f'{model_name:10} | {"+".join(coders):12} | {compressed:>10} bytes ({original / compressed:6.2f}x) '
+                   f'| encode : {original / t_enc / 1e6:8.2f} MB/s | decode : {original / t_dec / 1e6:8.2f} MB/s',
+                   verbose=True)
+
+
+def bench_size_estimate(model_name, load_path, logger):
+    """ Error and speedup of "estimate_model_size" against the sizes of the encoder """
+    model, quan_dict = get_quantized_model(model_name, load_path, logger)
+    cpu = torch.device('cpu')
+    encoder = HuffmanEncoder(BufferLogger())
+    with tempfile.TemporaryDirectory() as directory:
+        layer_sizes, sizes = encoder.huffman_encode_model(model, directory, 'container', quan_dict)
+        t_enc = get_time_per_iter(lambda: encoder.huffman_encode_model(model, directory, 'container', quan_dict),
+                                  args.n_iters, cpu)
+    est_layer_sizes, est_sizes = encoder.estimate_model_size(model, quan_dict)
+    t_est = get_time_per_iter(lambda: encoder.estimate_model_size(model, quan_dict), args.n_iters, cpu)
+    errors = [est_layer_sizes[name][1] - comp for name, (_, comp) in layer_sizes.items()]
+    logger.log(f'{model_name:10} | encoded : {sizes["Total"][1]:>10} bytes ({t_enc * 1e3:9.1f} ms) '
+               f'| estimated : {est_sizes["Total"][1]:>10} bytes ({t_est * 1e3:9.1f} ms, {t_enc / t_est:6.2f}x) '
+               f'| layer errors : {min(errors):+} / {max(errors):+} bytes', verbose=True)
+
+
+def bench_lut_inference(model_name, load_path, logger):
+    """
+    CPU latency and memory of the quantized layers computed from their shared values against dense weights
+    # The memory is divided by about 4 but the gathers cost more than they save, e.g. 0.13x-0.17x of the dense speed
+    # on alexnet at batch 1 and 0.66x-0.74x on resnet56 (16 values, half of the weights pruned)
+    """
+    model, quan_dict = get_quantized_model(model_name, load_path, logger)
+    model.eval()
+    shared_model = SharedExporter(logger).export(model, quan_dict)
+    shared_model.eval()
+    cpu = torch.device('cpu')
+    text = (f'{model_name:10} | dense : {SharedExporter.get_nbytes(model):>10} bytes '
+            f'| shared : {SharedExporter.get_nbytes(shared_model):>10} bytes')
+    for batch_size in args.batch_sizes:
+        x = torch.randn(batch_size, 3, 32, 32)
+        with torch.no_grad():
+            max_diff = torch.max(torch.abs(model(x) - shared_model(x))).item()
+            t_dense = get_time_per_iter(lambda: model(x), args.n_iters, cpu)
+            t_shared = get_time_per_iter(lambda: shared_model(x), args.n_iters, cpu)
+        text += (f' | batch {batch_size:>3} : dense {t_dense * 1e3:8.2f} ms, shared {t_shared * 1e3:8.2f} ms '
+                 f'({t_dense / t_shared:5.2f}x, max diff {max_diff:.1e})')
+    logger.log(text, verbose=True)
+
+
+def main():
+    set_seeds(args.seed)
+    check_dirs_exist(['saves'])
+    logger = Logger(args.log_path)
+    device = get_device(args.dev_idx)
+    logger.log_line()
+    logger.log(f'Task : {args.task} | Device : {device}', verbose=True)
+    if args.task == 'mask-grad':
+        for model_name in args.models:
+            bench_mask_grad(model_name, device, logger)
+    elif args.task == 'quan-grad':
+        for model_name in args.models:
+            bench_quan_grad(model_name, device, logger)
+    elif args.task == 'gm-approx':
+        for n_f, d in zip(args.layer_shapes[0::2], args.layer_shapes[1::2]):
+            bench_gm_approx(n_f, d, device, logger)
+    elif args.task == 'huffman-decode':
+        for n_symbols in args.n_symbols:
+            bench_huffman_decode(n_symbols, logger)
+    elif args.task == 'entropy-coders':
+        for model_name, load_path in zip(args.models, args.load_paths or [None] * len(args.models)):
+            bench_entropy_coders(model_name, load_path, logger)
+    elif args.task == 'lut-inference':
+        for model_name, load_path in zip(args.models, args.load_paths or [None] * len(args.models)):
+            bench_lut_inference(model_name, load_path, logger)
+    elif args.task == 'size-estimate':
+        for model_name, load_path in zip(args.models, args.load_paths or [None] * len(args.models)):
+            bench_size_estimate(model_name, load_path, logger)
+    else:
+        raise NameError(args.task)
+
+
+if __name__ == '__main__':
+    main()
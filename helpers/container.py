@@ -0,0 +1,184 @@
+import json
+import mmap
+import os
+import struct
+from pathlib import Path
+
+import numpy as np
+
+
+class DirectoryStore:
+    """
+    One file per entry in a directory, the layout written by "HuffmanEncoder" before the container existed.
+    ----------------------------------------------------------
+    The entries are raw bytes ("write" / "read") or pickled numpy arrays ("write_array" / "read_array").
+    ----------------------------------------------------------
+    """
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def write(self, name, payload, shape=None, dtype=None, encoding=None):
+        with open(self.directory/name, 'wb') as f:
+            f.write(payload)
+        return len(payload)
+
+    def read(self, name):
+        return np.fromfile(self.directory/name, dtype=np.uint8)
+
+    def __contains__(self, name):
+        return (self.directory/name).exists()
+
+    def write_array(self, name, arr):
+        arr.dump(self.directory/name)
+        return arr.nbytes
+
+    def read_array(self, name):
+        return np.load(self.directory/name, allow_pickle=True)
+
+    def close(self):
+        pass
+
+
+class MemoryStore:
+    """ Keeps the writes (of a worker process) to be done later on another store by "replay", in the same order """
+    def __init__(self):
+        self.records = list()  # (Method, args, kwargs)
+
+    def write(self, name, payload, **meta):
+        self.records.append(('write', (name, bytes(payload)), meta))
+        return len(payload)
+
+    def write_array(self, name, arr):
+        self.records.append(('write_array', (name, arr), dict()))
+        return arr.nbytes
+
+    def replay(self, store):
+        for method, args, kwargs in self.records:
+            getattr(store, method)(*args, **kwargs)
+
+    def close(self):
+        pass
+
+
+class SizeStore:
+    """ Counts the bytes of the entries without keeping them, for the estimation of the compressed sizes """
+    def __init__(self):
+        self.size = 0
+
+    def write(self, name, payload, **meta):
+        self.size += len(payload)
+        return len(payload)
+
+    def write_array(self, name, arr):
+        self.size += arr.nbytes
+        return arr.nbytes
+
+    def close(self):
+        pass
+
+
+class ContainerWriter:
+    """
+    Writes the entries of an encoded model into a single file.
+    ----------------------------------------------------------
+    Layout:
+        8 bytes  : MAGIC
+        8 bytes  : Length of the index (little-endian uint64)
+        index    : JSON {"version": 1, "entries": [{name, shape, dtype, encoding, offset, length}, ...]}
+        data     : The payloads of the entries, starting at the first multiple of ALIGN after the index. The offsets
+                   of the entries are relative to the start of the data and multiples of ALIGN.
+    The payloads are kept in memory until "close".
+    ----------------------------------------------------------
+    """
+    MAGIC = b'HFMODEL1'
+    ALIGN = 8
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.entries = list()
+        self.payloads = list()
+        self.size = 0  # Size of the data
+
+    def write(self, name, payload, shape=None, dtype=None, encoding='bytes'):
+        """ Adds an entry, returns the number of bytes of its payload """
+        payload = bytes(payload)
+        self.entries.append({
+            'name': name,
+            'shape': None if shape is None else list(shape),
+            'dtype': None if dtype is None else str(dtype),
+            'encoding': encoding,
+            'offset': self.size,
+            'length': len(payload),
+        })
+        self.payloads.append(payload)
+        self.size += len(payload) + (-len(payload) % self.ALIGN)
+        return len(payload)
+
+    def write_array(self, name, arr):
+        arr = np.asarray(arr, order='C')  # Keeps the 0-d arrays, unlike np.ascontiguousarray
+        return self.write(name, arr.tobytes(), shape=arr.shape, dtype=arr.dtype, encoding='raw')
+
+    def close(self):
+        """ Writes the file, returns its size """
+        index = json.dumps({'version': self.VERSION, 'entries': self.entries}, separators=(',', ':')).encode()
+        head = self.MAGIC + struct.pack('<Q', len(index)) + index
+        with open(self.path, 'wb') as f:
+            f.write(head + b'\0' * (-len(head) % self.ALIGN))
+            for payload in self.payloads:
+                f.write(payload + b'\0' * (-len(payload) % self.ALIGN))
+        self.payloads = list()
+        return os.path.getsize(self.path)
+
+
+class ContainerReader:
+    """
+    Random access to the entries of a file written by "ContainerWriter".
+    ----------------------------------------------------------
+    With "use_mmap", the file is memory-mapped and the entries are returned as read-only views of the mapping,
+    so that only the pages of the entries which are read are loaded. Otherwise every entry is read with a seek.
+    ----------------------------------------------------------
+    """
+    def __init__(self, path, use_mmap=True):
+        self.path = Path(path)
+        self.file = open(self.path, 'rb')
+        magic = self.file.read(len(ContainerWriter.MAGIC))
+        if magic != ContainerWriter.MAGIC:
+            raise ValueError(f'{self.path} is not an encoded model container')
+        n_index, = struct.unpack('<Q', self.file.read(8))
+        index = json.loads(self.file.read(n_index).decode())
+        if index['version'] != ContainerWriter.VERSION:
+            raise ValueError(f'Unsupported container version {index["version"]}')
+        head = len(ContainerWriter.MAGIC) + 8 + n_index
+        self.data_offset = head + (-head % ContainerWriter.ALIGN)
+        self.entries = {entry['name']: entry for entry in index['entries']}
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if use_mmap else None
+
+    def names(self):
+        return list(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def read(self, name):
+        entry = self.entries[name]
+        offset = self.data_offset + entry['offset']
+        if self.mm is not None:
+            return np.frombuffer(self.mm, dtype=np.uint8, count=entry['length'], offset=offset)
+        self.file.seek(offset)
+        return np.frombuffer(self.file.read(entry['length']), dtype=np.uint8)
+
+    def read_array(self, name):
+        entry = self.entries[name]
+        return self.read(name).view(entry['dtype']).reshape(entry['shape'])
+
+    def close(self):
+        # The views returned by "read" must not be used after closing
+        if self.mm is not None:
+            try:
+                self.mm.close()
+            except BufferError:  # Views still alive, the mapping is released with them
+                pass
+            self.mm = None
+        self.file.close()
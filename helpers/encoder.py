@@ -1,10 +1,15 @@
+import copy
+import math
 import os
-from collections import defaultdict, namedtuple
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from heapq import heappush, heappop, heapify
 import struct
 from pathlib import Path
 
+from helpers.container import DirectoryStore, MemoryStore, SizeStore, ContainerWriter, ContainerReader
 from helpers.pruner import FiltersPruner
+from helpers.utils import BufferLogger
 
 import torch
 import numpy as np
@@ -14,32 +19,33 @@ Node.__lt__ = lambda x, y: x.freq < y.freq
 
 
 class HuffmanEncoder:
-    def __init__(self, logger):
+    CONTAINER_NAME = 'model.hfm'
+    CANONICAL_MAGIC = 0xC0  # First byte of a canonical codebook, a tree codebook starts with its padding (0 - 7)
+    RANS_MAGIC = 0xA0  # First byte of the codebook (frequency table) of an array coded by rANS
+    INDEX_BITMAP, INDEX_DELTA, INDEX_RUNS = range(3)  # Layouts of the indices of the left filters / channels
+
+    def __init__(self, logger, canonical=True, n_workers=1, coders=('huffman', 'rans')):
         self.logger = logger
+        self.canonical = canonical  # Canonical codebooks, or the huffman trees of the former format
+        self.n_workers = n_workers  # Processes encoding / decoding the layers, 1 : in this process
+        self.coders = tuple(coders)  # Entropy coders tried for every array, the smallest output is kept (or huffman)
+        self.sizes_only = False  # Writes zeros of the size of the coded data instead of coding it (estimation)
+        self.rans = RansCoder()
 
     # My own self.dump / load logics
     @staticmethod
-    def _dump(code_str, filename):
+    def _dump(packed, n_bits, store, name, **meta):
         """
-        code_str : string of either '0' and '1' characters
-        this function self.dumps to a file
+        packed : uint8 array of "n_bits" bits packed by np.packbits (MSB first, zero padded to the byte boundary)
+        this function self.dumps to the entry "name" of "store" (a file of the directory or of the container)
         returns how many bytes are written
         """
-        # Make header (1 byte) and add padding to the end
+        # Make header (1 byte), the padding is already at the end of "packed"
         # Files need to be byte aligned.
         # Therefore we add 1 byte as a header which indicates how many bits are padded to the end
         # This introduces minimum of 8 bits, maximum of 15 bits overhead
-        num_of_padding = -len(code_str) % 8
-        header = f"{num_of_padding:08b}"
-        code_str = header + code_str + '0' * num_of_padding
-
-        # Convert string to integers and to real bytes
-        byte_arr = bytearray(int(code_str[i:i + 8], 2) for i in range(0, len(code_str), 8))
-
-        # Dump to a file
-        with open(filename, 'wb') as f:
-            f.write(byte_arr)
-        return len(byte_arr)
+        num_of_padding = -n_bits % 8
+        return store.write(name, bytes([num_of_padding]) + packed.tobytes(), **meta)
 
     @staticmethod
     def _load(filename):
@@ -55,22 +61,21 @@ class HuffmanEncoder:
                 code_str = code_str[:-offset]  # String of '0's and '1's
         return code_str
 
-    # Helper functions for converting between bit string and (float or int)
     @staticmethod
-    def _float2bitstr(f):
-        four_bytes = struct.pack('>f', f)  # Bytes
-        return ''.join(f'{byte:08b}' for byte in four_bytes)  # String of '0's and '1's
+    def _load_bytes(store, name):
+        """
+        This function reads an entry written by "_dump"
+        returns the uint8 array of the bytes after the header and the number of bits
+        """
+        payload = store.read(name)
+        return payload[1:], 8 * (len(payload) - 1) - int(payload[0])
 
+    # Helper functions for converting between bit string and (float or int)
     @staticmethod
     def _bitstr2float(bitstr):
         byte_arr = bytearray(int(bitstr[i:i + 8], 2) for i in range(0, len(bitstr), 8))
         return struct.unpack('>f', byte_arr)[0]
 
-    @staticmethod
-    def _int2bitstr(integer):
-        four_bytes = struct.pack('>I', integer)  # Bytes
-        return ''.join(f'{byte:08b}' for byte in four_bytes)  # String of '0's and '1's
-
     @staticmethod
     def _bitstr2int(bitstr):
         byte_arr = bytearray(int(bitstr[i:i + 8], 2) for i in range(0, len(bitstr), 8))
@@ -85,24 +90,15 @@ class HuffmanEncoder:
     def _reconstruct_indptr(diff):
         return np.concatenate([[0], np.cumsum(diff)])
 
-    def _huffman_encode(self, arr, prefix, save_dir='./'):
+    @staticmethod
+    def _get_huffman_tree(values, freqs):
         """
-        Encodes numpy array 'arr' and saves to `save_dir`
-        The names of binary files are prefixed with `prefix`
-        returns the number of bytes for the tree and the data after the compression
+        Builds the huffman tree of "values" (in the order of their first occurrences) with their frequencies
+        returns the root and the leaves (leaves[i] holds values[i])
         """
-        # Infer dtype
-        dtype = str(arr.dtype)
-
-        # Calculate frequency in arr
-        freq_map = defaultdict(int)
-        convert_map = {'float32': float, 'int32': int}
-        for value in np.nditer(arr):
-            value = convert_map[dtype](value)
-            freq_map[value] += 1
-
         # Make heap
-        heap = [Node(frequency, value, None, None) for value, frequency in freq_map.items()]
+        leaves = [Node(frequency, value, None, None) for value, frequency in zip(values, freqs)]
+        heap = list(leaves)
         heapify(heap)
 
         # Merge nodes
@@ -117,38 +113,124 @@ class HuffmanEncoder:
                 node2 = heappop(heap)
                 merged = Node(node1.freq + node2.freq, None, node1, node2)
                 heappush(heap, merged)
+        return heappop(heap), leaves
 
-        # Generate code value mapping
-        value2code = {}
-
-        def generate_code(node, code):
-            if node is None:
-                return
+    @staticmethod
+    def _get_codes(root, leaves):
+        """
+        Code of every leaf as an integer (MSB first) and its length, left = '0' and right = '1'
+        """
+        # NOTE: Keyed by value, so the dummy leaf (value 0) of a single value tree overwrites the code of the value
+        #       if it equals 0, as in the former string encoder
+        index = {leaf.value: i for i, leaf in enumerate(leaves)}
+        codes = np.zeros(len(leaves), dtype=np.uint64)
+        lengths = np.zeros(len(leaves), dtype=np.int64)
+        stack = [(root, 0, 0)]
+        while stack:  # Iterative, skewed trees can be deeper than the recursion limit
+            node, code, length = stack.pop()
             if node.value is not None:
-                value2code[node.value] = code
-                return
-            generate_code(node.left, code + '0')
-            generate_code(node.right, code + '1')
+                if node.value in index:
+                    codes[index[node.value]] = code
+                    lengths[index[node.value]] = length
+                continue
+            stack.append((node.right, (code << 1) | 1, length + 1))
+            stack.append((node.left, code << 1, length + 1))
+        # Huffman codes of less than 2^32 values are at most ~46 bits long
+        assert lengths.max() <= 64, 'Huffman codes longer than 64 bits'
+        return codes, lengths
+
+    @staticmethod
+    def _pack_codes(symbols, codes, lengths, chunk=1 << 20):
+        """
+        Concatenates the codes of "symbols" (indices of "codes" and "lengths") and packs the bits into bytes
+        returns the packed uint8 array and the number of bits
+        # Processed by chunks of symbols, the bits past the last byte boundary of a chunk are carried to the next one
+        """
+        packed = list()
+        carry = np.zeros(0, dtype=np.uint8)
+        n_bits = 0
+        for start in range(0, len(symbols), chunk):
+            sym = symbols[start:start + chunk]
+            lens = lengths[sym]
+            n = int(np.sum(lens))
+            pos = np.arange(n) - np.repeat(np.cumsum(lens) - lens, lens)  # Position of the bit in its code
+            shifts = (np.repeat(lens, lens) - 1 - pos).astype(np.uint64)
+            bits = ((np.repeat(codes[sym], lens) >> shifts) & np.uint64(1)).astype(np.uint8)
+            bits = np.concatenate((carry, bits))
+            n_full = len(bits) // 8 * 8
+            packed.append(np.packbits(bits[:n_full]))
+            carry = bits[n_full:]
+            n_bits += n
+        packed.append(np.packbits(carry))
+        return np.concatenate(packed), n_bits
+
+    @staticmethod
+    def _get_uniques(flat):
+        """
+        First occurrences, inverse indices and counts of the sorted unique values of "flat" (see np.unique)
+        # Small non-negative integers (e.g. cluster indices) are counted with np.bincount instead of sorting
+        """
+        if flat.dtype.kind == 'i' and len(flat) > 0 and 0 <= np.min(flat) and np.max(flat) < 1 << 16:
+            counts = np.bincount(flat)
+            present = np.nonzero(counts)[0]
+            first = np.full(len(counts), len(flat), dtype=np.int64)
+            np.minimum.at(first, flat, np.arange(len(flat)))
+            inverse = np.cumsum(counts > 0) - 1
+            return first[present], inverse[flat], counts[present]
+        _, first, inverse, counts = np.unique(flat, return_index=True, return_inverse=True, return_counts=True)
+        return first, inverse, counts
 
-        root = heappop(heap)
-        generate_code(root, '')
+    def _huffman_encode(self, arr, prefix, store, uniques=None):
+        """
+        Encodes numpy array 'arr' and saves to `store` ("DirectoryStore" or "ContainerWriter")
+        The names of binary files are prefixed with `prefix`
+        uniques : "_get_uniques" of the flattened 'arr' (the values may be counted in any order), if already known
+        returns the number of bytes for the tree and the data after the compression
+        """
+        # Infer dtype
+        dtype = str(arr.dtype)
+        assert dtype in ('float32', 'int32'), dtype
 
-        # Path to save location
-        directory = Path(save_dir)
+        # Calculate frequency in arr, in the iteration order of np.nditer
+        # NOTE: The values are ordered by their first occurrences (and -0.0 / 0.0 share the first one) for the heap
+        #       to break the ties exactly like a dict filled while iterating the array
+        flat = arr.ravel(order='K')
+        first, symbols, freqs = self._get_uniques(flat) if uniques is None else uniques
+        order = np.argsort(first)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        values = flat[first[order]].tolist()  # Python floats / ints
+        root, leaves = self._get_huffman_tree(values, freqs[order].tolist())
+        codes, lengths = self._get_codes(root, leaves)
+        if self.canonical:  # Same lengths, the codes are reassigned in the canonical order
+            keys = flat[first[order]].view(np.uint32)
+            canonical_order = np.lexsort((keys, lengths))
+            codes[canonical_order] = get_canonical_codes(lengths[canonical_order]).astype(np.uint64)
 
         # Dump data
-        data_encoding = ''.join(value2code[convert_map[dtype](value)] for value in np.nditer(arr))
-        datasize = self._dump(data_encoding, directory/f'{prefix}.bin')
+        if self.sizes_only:
+            n_bits = int(np.sum(freqs[order] * lengths))
+            packed = np.zeros(-(-n_bits // 8), dtype=np.uint8)
+        else:
+            packed, n_bits = self._pack_codes(rank[symbols.reshape(-1)], codes, lengths)
+        datasize = self._dump(packed, n_bits, store, f'{prefix}.bin', shape=arr.shape, dtype=dtype,
+                              encoding='huffman')
 
-        # Dump codebook (huffman tree)
-        codebook_encoding = self._encode_huffman_tree(root, dtype)
-        treesize = self._dump(codebook_encoding, directory/f'{prefix}_codebook.bin')
+        # Dump codebook (canonical or huffman tree)
+        if self.canonical:
+            payload = self._encode_canonical_codebook(keys[canonical_order], lengths[canonical_order])
+            treesize = store.write(f'{prefix}_codebook.bin', payload, dtype=dtype, encoding='huffman-canonical')
+        else:
+            packed, n_bits = self._encode_huffman_tree(root, dtype)
+            treesize = self._dump(packed, n_bits, store, f'{prefix}_codebook.bin', dtype=dtype,
+                                  encoding='huffman-tree')
 
         return treesize, datasize
 
-    def _huffman_decode(self, directory, prefix, dtype):
+    def _huffman_decode_bitstr(self, directory, prefix, dtype):
         """
         Decodes binary files from directory
+        # The former decoder walking the tree bit by bit over a string of '0's and '1's, kept for comparison (files only)
         """
         directory = Path(directory)
 
@@ -170,27 +252,221 @@ class HuffmanEncoder:
 
         return np.array(data, dtype=dtype)
 
+    def _huffman_decode(self, store, prefix, dtype, out=None, table=None):
+        """
+        Decodes binary files from `store` into "out" (a preallocated array of the decoded size, or None)
+        With "table", the decoded values are indices of "table" and the entries of "table" are returned
+        """
+        # Read the codebook
+        codebook = store.read(f'{prefix}_codebook.bin')
+        if codebook[0] == self.CANONICAL_MAGIC:
+            keys, lengths = self._decode_canonical_codebook(codebook)
+            values = keys.view(dtype)
+            decoder = CanonicalHuffmanDecoder(lengths)
+        else:
+            tree, n_tree_bits = self._load_bytes(store, f'{prefix}_codebook.bin')
+            children, values = self._decode_huffman_tree_arrays(tree, n_tree_bits, dtype)
+            decoder = HuffmanTreeDecoder(children)
+
+        # Read and decode the data
+        data, n_bits = self._load_bytes(store, f'{prefix}.bin')
+        symbols = decoder.decode(data, n_bits)
+
+        if table is not None:
+            values = table[values]
+        if out is None:
+            out = np.empty(len(symbols), dtype=values.dtype)
+        return np.take(values, symbols, out=out.reshape(-1)).reshape(out.shape)
+
+    # Entropy coding interface, every array is coded by the coder of "coders" giving the smallest output
+    def _entropy_encode(self, arr, prefix, store, uniques=None):
+        """
+        Encodes numpy array 'arr' to `store` with the best of "coders" ("huffman" or "rans"), with huffman if none of
+        them can encode it (rANS is limited to 65536 distinct values)
+        uniques : "_get_uniques" of the flattened 'arr', if already known
+        returns the number of bytes for the codebook and the data
+        """
+        encode_fns = {'huffman': self._huffman_encode, 'rans': self._rans_encode}
+        if self.coders == ('huffman',):
+            return self._huffman_encode(arr, prefix, store, uniques)
+        best_store, best_sizes = None, None
+        for coder in self.coders:
+            memory_store = MemoryStore()
+            if coder == 'rans' and best_sizes is not None:
+                sizes = self._rans_encode(arr, prefix, memory_store, uniques, limit=sum(best_sizes))
+            else:
+                sizes = encode_fns[coder](arr, prefix, memory_store, uniques)
+            if sizes is not None and (best_sizes is None or sum(sizes) < sum(best_sizes)):
+                best_store, best_sizes = memory_store, sizes
+        if best_store is None:
+            return self._huffman_encode(arr, prefix, store, uniques)
+        best_store.replay(store)
+        return best_sizes
+
+    def _entropy_decode(self, store, prefix, dtype, out=None, table=None):
+        """ Decodes an array encoded by "_entropy_encode", the coder is given by the first byte of the codebook """
+        codebook = store.read(f'{prefix}_codebook.bin')
+        if codebook[0] == self.RANS_MAGIC:
+            return self._rans_decode(store, prefix, codebook, dtype, out, table)
+        return self._huffman_decode(store, prefix, dtype, out, table)
+
+    def _rans_encode(self, arr, prefix, store, uniques=None, limit=None):
+        """
+        Encodes numpy array 'arr' with "RansCoder", the codebook holds the number of values, the sorted distinct values
+        (uint32 bit patterns, delta coded) and their quantized frequencies as varints after RANS_MAGIC
+        returns the number of bytes for the codebook and the data, None if there are too many distinct values or if
+        the size can not be below "limit"
+        """
+        dtype = str(arr.dtype)
+        assert dtype in ('float32', 'int32'), dtype
+        flat = arr.ravel(order='K')
+        first, symbols, counts = self._get_uniques(flat) if uniques is None else uniques
+        keys = flat[first].view(np.uint32)
+        order = np.argsort(keys, kind='stable')
+        freqs = self.rans.get_freqs(counts[order])
+        if freqs is None or limit is not None and self.rans.get_min_size(counts[order], freqs) >= limit:
+            return None
+        if self.sizes_only:
+            payload = bytes(self.rans.get_size(counts[order], freqs))
+        else:
+            rank = np.empty_like(order)
+            rank[order] = np.arange(len(order))
+            payload = self.rans.encode(rank[symbols], freqs)
+        datasize = store.write(f'{prefix}.bin', payload, shape=arr.shape, dtype=dtype, encoding='rans')
+        codebook = bytes([self.RANS_MAGIC]) + self._encode_varints([len(flat), len(keys)]) + \
+            self._encode_varints(np.diff(keys[order].astype(np.int64), prepend=0)) + self._encode_varints(freqs)
+        treesize = store.write(f'{prefix}_codebook.bin', codebook, dtype=dtype, encoding='rans-freqs')
+        return treesize, datasize
+
+    def _rans_decode(self, store, prefix, codebook, dtype, out=None, table=None):
+        (n, n_keys), n0 = self._decode_varints(codebook[1:], 2)
+        deltas, n1 = self._decode_varints(codebook[1 + n0:], int(n_keys))
+        freqs, _ = self._decode_varints(codebook[1 + n0 + n1:], int(n_keys))
+        values = np.cumsum(deltas.astype(np.int64)).astype(np.uint32).view(dtype)
+        symbols = self.rans.decode(store.read(f'{prefix}.bin'), freqs.astype(np.int64), int(n))
+        if table is not None:
+            values = table[values]
+        if out is None:
+            out = np.empty(len(symbols), dtype=values.dtype)
+        return np.take(values, symbols, out=out.reshape(-1)).reshape(out.shape)
+
+    def _huffman_encode_labels(self, arr, labels, prefix, store):
+        """
+        Encodes the weights "arr" like "_entropy_encode", with their histogram counted on their cluster indices
+        "labels" (-1 : zero weight, see "PostQuantizer.get_quan_dict()") instead of sorting their float values
+        returns the number of bytes for the codebook and the data, None if "labels" do not map one to one to "arr"
+        # The centroids are the keys of the codebook, so the output is the one of the values (decoded as such). The
+        # indices coded with a separate table of the centroids (the former layout, still decoded) were larger
+        """
+        arr = np.ascontiguousarray(arr)  # The order of "ravel(order='K')" is the order of "labels"
+        symbols = labels.astype(np.int32).reshape(-1) + 1  # 0 : zero weight
+        table = np.zeros(int(np.max(symbols, initial=0)) + 1, dtype=np.float32)
+        table[symbols] = arr.reshape(-1)
+        if not np.array_equal(table[symbols], arr.reshape(-1)):  # Not (or no longer) shared weights
+            return None
+        first, inverse, counts = self._get_uniques(symbols)
+        if len(np.unique(table[symbols[first]])) < len(first):  # Clusters of the same value, a single key
+            return None
+        return self._entropy_encode(arr, prefix, store, uniques=(first, inverse, counts))
+
+    def _huffman_decode_values(self, store, prefix, out):
+        """ Decodes the weights encoded by "_huffman_encode_values" into "out" """
+        if f'{prefix}_centroids.bin' in store:  # Cluster indices and table of the centroids of the former layout
+            table = np.concatenate(([0.], store.read(f'{prefix}_centroids.bin').view(np.float32))).astype(np.float32)
+            return self._entropy_decode(store, f'{prefix}_labels', dtype='int32', out=out, table=table)
+        return self._entropy_decode(store, prefix, dtype='float32', out=out)
+
+    def _huffman_encode_values(self, arr, labels, prefix, store):
+        """ Encodes the weights "arr" by their cluster indices "labels" if given (and valid), or by their values """
+        sizes = None if labels is None else self._huffman_encode_labels(arr, labels, prefix, store)
+        return self._entropy_encode(arr, prefix, store) if sizes is None else sizes
+
+    # Logics to encode / decode canonical codebooks
+    @staticmethod
+    def _encode_varints(values):
+        """ LEB128 bytes of the non-negative integers "values": 7 bits per byte, 0x80 set on all but the last byte """
+        values = np.asarray(values, dtype=np.uint64)
+        shifts = (7 * np.arange(10)).astype(np.uint64)
+        groups = ((values[:, None] >> shifts) & np.uint64(0x7F)).astype(np.uint8)  # (n, 10)
+        n_bytes = 1 + np.sum((values[:, None] >> shifts[1:]) > 0, axis=1)
+        groups[np.arange(10) < n_bytes[:, None] - 1] |= 0x80
+        return groups[np.arange(10) < n_bytes[:, None]].tobytes()
+
+    @staticmethod
+    def _decode_varints(data, count):
+        """ The first "count" integers of the LEB128 bytes "data", returns them and the number of bytes read """
+        if count == 0:
+            return np.zeros(0, dtype=np.uint64), 0
+        ends = np.nonzero((data & 0x80) == 0)[0][:count]
+        starts = np.concatenate(([0], ends[:-1] + 1))
+        n_bytes = ends - starts + 1
+        shifts = 7 * (np.arange(ends[-1] + 1) - np.repeat(starts, n_bytes))
+        values = np.zeros(count, dtype=np.uint64)
+        np.add.at(values, np.repeat(np.arange(count), n_bytes),
+                  (data[:ends[-1] + 1].astype(np.uint64) & np.uint64(0x7F)) << shifts.astype(np.uint64))
+        return values, int(ends[-1]) + 1
+
+    def _encode_canonical_codebook(self, keys, lengths):
+        """
+        Codebook of canonical codes, "keys" are the uint32 bit patterns of the values sorted by (code length, key)
+        ----------------------------------------------------------
+        Layout:
+            1 byte : CANONICAL_MAGIC
+            1 byte : Max code length
+            varints: Number of codes of every length from 1 to the max length
+            varints: Keys of every length, the first one then the differences to the previous one
+        ----------------------------------------------------------
+        """
+        max_len = int(np.max(lengths))
+        counts = np.bincount(lengths, minlength=max_len + 1)[1:]
+        keys = keys.astype(np.int64)
+        deltas = np.diff(keys, prepend=0)
+        starts = (np.cumsum(counts) - counts)[counts > 0]
+        deltas[starts] = keys[starts]
+        return bytes([self.CANONICAL_MAGIC, max_len]) + self._encode_varints(counts) + self._encode_varints(deltas)
+
+    def _decode_canonical_codebook(self, codebook):
+        """ Decodes "_encode_canonical_codebook", returns the uint32 keys and their code lengths """
+        max_len = int(codebook[1])
+        counts, n_read = self._decode_varints(codebook[2:], max_len)
+        counts = counts.astype(np.int64)
+        deltas = self._decode_varints(codebook[2 + n_read:], int(np.sum(counts)))[0].astype(np.int64)
+        starts = (np.cumsum(counts) - counts)[counts > 0]
+        sums = np.cumsum(deltas)
+        keys = sums - np.repeat(sums[starts] - deltas[starts], counts[counts > 0])  # Sums restarting every length
+        return keys.astype(np.uint32), np.repeat(np.arange(1, max_len + 1), counts)
+
     # Logics to encode / decode huffman tree
     # Referenced the idea from https://stackoverflow.com/questions/759707/efficient-way-of-storing-huffman-tree
-    def _encode_huffman_tree(self, root, dtype):
+    @staticmethod
+    def _encode_huffman_tree(root, dtype):
         """
-        Encodes a huffman tree to string of '0's and '1's
+        Encodes a huffman tree in preorder, '0' for an internal node and '1' followed by the 32 bits of the value for
+        a leaf node
+        returns the packed uint8 array and the number of bits
         """
-        converter = {'float32': self._float2bitstr, 'int32': self._int2bitstr}
-        code_list = []
-
-        def encode_node(node):
+        flags = list()
+        values = list()
+        stack = [root]
+        while stack:
+            node = stack.pop()
             if node.value is not None:  # Node is leaf node
-                code_list.append('1')
-                lst = list(converter[dtype](node.value))
-                code_list.extend(lst)
+                flags.append(1)
+                values.append(node.value)
             else:
-                code_list.append('0')
-                encode_node(node.left)
-                encode_node(node.right)
-        encode_node(root)
+                flags.append(0)
+                stack.append(node.right)
+                stack.append(node.left)
+        flags = np.array(flags, dtype=np.uint8)
+        values = np.array(values, dtype={'float32': '>f4', 'int32': '>u4'}[dtype])
 
-        return ''.join(code_list)
+        seg_lengths = np.where(flags == 1, 33, 1)
+        starts = np.cumsum(seg_lengths) - seg_lengths
+        bits = np.zeros(int(np.sum(seg_lengths)), dtype=np.uint8)
+        bits[starts] = flags
+        value_bits = np.unpackbits(values.view(np.uint8).reshape(-1, 4), axis=1)  # (n_leaves, 32)
+        bits[starts[flags == 1][:, None] + 1 + np.arange(32)] = value_bits
+        return np.packbits(bits), len(bits)
 
     def _decode_huffman_tree(self, code_str, dtype):
         """
@@ -214,17 +490,147 @@ class HuffmanEncoder:
 
         return decode_node()
 
-    def _huffman_encode_conv(self, param, name, directory, left_dict):
+    def _decode_huffman_tree_arrays(self, data, n_bits, dtype):
+        """
+        Decodes a huffman tree encoded by "_encode_huffman_tree" into arrays
+        returns children (n_internal, 2) and the values of the leaves (n_leaves,)
+        # children[i] holds the left and right children of the internal node i, an internal node as its index and a
+        # leaf node j as ~j (negative)
+        """
+        bits = np.unpackbits(data)[:n_bits]
+        flags = bits.tolist()
+        children = list()
+        leaf_starts = list()
+        stack = list()  # (Internal node, side) waiting for a child
+        idx = 0
+        while True:
+            if flags[idx] == 1:  # Leaf node
+                node = ~len(leaf_starts)
+                leaf_starts.append(idx + 1)
+                idx += 33
+            else:
+                node = len(children)
+                children.append([0, 0])
+                idx += 1
+            if stack:
+                parent, side = stack.pop()
+                children[parent][side] = node
+            if node >= 0:
+                stack.append((node, 1))
+                stack.append((node, 0))
+            if not stack:
+                break
+        value_bits = bits[np.array(leaf_starts)[:, None] + np.arange(32)]
+        values = np.packbits(value_bits, axis=1).reshape(-1).view({'float32': '>f4', 'int32': '>u4'}[dtype])
+        return np.array(children, dtype=np.int64).reshape(-1, 2), values.astype(dtype)
+
+    # Logics to encode / decode the sparse layouts
+    def _encode_indices(self, ind, n):
+        """
+        Encodes the sorted indices "ind" of the left filters (or channels) out of "n" as bytes, in the smallest of:
+            INDEX_BITMAP : Bitmap of the n filters (np.packbits)
+            INDEX_DELTA  : Number of indices, then the gaps between the consecutive indices
+            INDEX_RUNS   : Number of runs, then the lengths of the alternating runs of left / pruned filters (the
+                           first run is of left filters and may be empty)
+        The first byte is the layout, the integers are LEB128 varints
+        """
+        mask = np.zeros(n, dtype=bool)
+        mask[ind] = True
+        gaps = np.diff(ind, prepend=-1) - 1
+        runs = np.diff(np.concatenate(([0], np.nonzero(np.diff(mask))[0] + 1, [n])))
+        if n > 0 and not mask[0]:
+            runs = np.concatenate(([0], runs))
+        layouts = [
+            bytes([self.INDEX_BITMAP]) + np.packbits(mask).tobytes(),
+            bytes([self.INDEX_DELTA]) + self._encode_varints([len(ind)]) + self._encode_varints(gaps),
+            bytes([self.INDEX_RUNS]) + self._encode_varints([len(runs)]) + self._encode_varints(runs),
+        ]
+        return min(layouts, key=len)
+
+    def _decode_indices(self, data, n):
+        """ Decodes the indices encoded by "_encode_indices" at the start of "data", returns them and the bytes read """
+        layout = data[0]
+        if layout == self.INDEX_BITMAP:
+            n_bytes = (n + 7) // 8
+            return np.nonzero(np.unpackbits(data[1:1 + n_bytes])[:n])[0].astype(np.int32), 1 + n_bytes
+        count, n0 = self._decode_varints(data[1:], 1)
+        values, n1 = self._decode_varints(data[1 + n0:], int(count[0]))
+        values = values.astype(np.int64)
+        if layout == self.INDEX_DELTA:
+            ind = np.cumsum(values + 1) - 1
+        elif layout == self.INDEX_RUNS:
+            mask = np.repeat(np.arange(len(values)) % 2 == 0, values)
+            ind = np.nonzero(mask)[0]
+        else:
+            raise ValueError(f'Unknown index layout {layout}')
+        return ind.astype(np.int32), 1 + n0 + n1
+
+    def _huffman_encode_csr(self, arr, labels, prefix, store):
+        """
+        Encodes the nonzero weights of "arr" (n_rows, ...) in CSR: the number of nonzero weights of every row, the gaps
+        between the columns of the consecutive nonzero weights of a row, and the nonzero weights (or their labels)
+        returns the number of bytes for the trees and the data
+        """
+        arr2d = arr.reshape(len(arr), -1)
+        rows, cols = np.nonzero(arr2d)
+        indptr = np.searchsorted(rows, np.arange(len(arr2d) + 1))
+        starts = indptr[:-1][self._calc_index_diff(indptr) > 0]  # First nonzero weights of the rows
+        gaps = np.diff(cols, prepend=-1) - 1
+        gaps[starts] = cols[starts]
+        t0, d0 = self._entropy_encode(self._calc_index_diff(indptr).astype(np.int32), f'{prefix}_csr_rows', store)
+        t1, d1 = self._entropy_encode(gaps.astype(np.int32), f'{prefix}_csr_gaps', store)
+        t2, d2 = self._huffman_encode_values(arr2d[rows, cols], None if labels is None else
+                                             labels.reshape(len(arr2d), -1)[rows, cols], prefix, store)
+        return t0 + t1 + t2, d0 + d1 + d2
+
+    def _huffman_decode_csr(self, store, prefix, out):
+        """ Decodes the weights encoded by "_huffman_encode_csr" into "out" """
+        indptr = self._reconstruct_indptr(self._entropy_decode(store, f'{prefix}_csr_rows', dtype='int32'))
+        steps = self._entropy_decode(store, f'{prefix}_csr_gaps', dtype='int32').astype(np.int64) + 1
+        counts = self._calc_index_diff(indptr)
+        starts = indptr[:-1][counts > 0]
+        sums = np.cumsum(steps)
+        cols = sums - np.repeat(sums[starts] - steps[starts], counts[counts > 0]) - 1  # Sums restarting every row
+        rows = np.repeat(np.arange(len(counts)), counts)
+        out2d = out.reshape(len(counts), -1)
+        out2d[:] = 0.
+        out2d[rows, cols] = self._huffman_decode_values(store, prefix, out=np.empty(len(rows), dtype=np.float32))
+        return out
+
+    def _huffman_encode_block(self, arr, labels, prefix, store):
+        """
+        Encodes the weights "arr" (n_rows, ...) densely or in CSR, whichever is smaller
+        # CSR is only tried for the weights more than half zero (e.g. after "_prune_by_percentile"): otherwise the
+        # zeros cost about 1 bit each densely, which the gaps of CSR never beat
+        """
+        dense = MemoryStore()
+        sizes = self._huffman_encode_values(arr, labels, prefix, dense)
+        if 2 * np.count_nonzero(arr) < arr.size:
+            csr = MemoryStore()
+            csr_sizes = self._huffman_encode_csr(arr, labels, prefix, csr)
+            if sum(csr_sizes) < sum(sizes):
+                dense, sizes = csr, csr_sizes
+        dense.replay(store)
+        return sizes
+
+    def _huffman_decode_block(self, store, prefix, out):
+        if f'{prefix}_csr_rows.bin' in store:
+            return self._huffman_decode_csr(store, prefix, out)
+        return self._huffman_decode_values(store, prefix, out)
+
+    def _huffman_encode_conv(self, param, name, store, left_dict, labels=None):
         left_w, left_f, left_c = left_dict[name]
 
         # Encode
-        t0, d0 = self._huffman_encode(left_w, f'{name}_data', directory)
-        t1, d1 = self._huffman_encode(left_f, f'{name}_f_indices', directory)
-        t2, d2 = self._huffman_encode(left_c, f'{name}_c_indices', directory)
+        if labels is not None:
+            labels = labels[left_f[:, None], left_c]
+        t0, d0 = self._huffman_encode_block(left_w, labels, f'{name}_data', store)
+        indices = self._encode_indices(left_f, param.shape[0]) + self._encode_indices(left_c, param.shape[1])
+        t1 = store.write(f'{name}_indices.bin', indices, encoding='sparse-indices')
 
         # Print statistics
         original = param.data.cpu().numpy().nbytes
-        compressed = t0 + t1 + t2 + d0 + d1 + d2
+        compressed = t0 + t1 + d0
         log_text = (
             f"{name:<35} | {original:20} {compressed:20} {original / compressed:>10.2f}x "
             f"{100 * compressed / original:>6.2f}%"
@@ -233,25 +639,31 @@ class HuffmanEncoder:
 
         return original, compressed
 
-    def _huffman_decode_conv(self, param, name, directory):
+    def _huffman_decode_conv(self, param, name, store, out=None):
         # Decode data
-        left_w = self._huffman_decode(directory, f'{name}_data', dtype='float32')
-        left_f = self._huffman_decode(directory, f'{name}_f_indices', dtype='int32')
-        left_c = self._huffman_decode(directory, f'{name}_c_indices', dtype='int32')
+        if f'{name}_indices.bin' in store:
+            indices = store.read(f'{name}_indices.bin')
+            left_f, n_read = self._decode_indices(indices, param.shape[0])
+            left_c, _ = self._decode_indices(indices[n_read:], param.shape[1])
+        else:  # Huffman coded indices of the former format
+            left_f = self._huffman_decode(store, f'{name}_f_indices', dtype='int32')
+            left_c = self._huffman_decode(store, f'{name}_c_indices', dtype='int32')
+        weight = np.empty(tuple(param.shape), dtype=np.float32) if out is None else out
+        if len(left_f) == param.shape[0] and len(left_c) == param.shape[1]:  # Nothing pruned
+            return self._huffman_decode_block(store, f'{name}_data', out=weight)
+        left_w = np.empty((len(left_f), len(left_c)) + tuple(param.shape[2:]), dtype=np.float32)
+        self._huffman_decode_block(store, f'{name}_data', out=left_w)
 
         # Reconstruct weight
-        weight = np.zeros(param.shape)
-        weight[left_f[:, None], left_c] = left_w.reshape(weight[left_f[:, None], left_c].shape)
-
-        # Return the parameters
-        param = torch.from_numpy(weight).to(param.device)
-        return param
+        weight[...] = 0.
+        weight[left_f[:, None], left_c] = left_w
+        return weight
 
-    def _huffman_encode_fc(self, param, name, directory):
+    def _huffman_encode_fc(self, param, name, store, labels=None):
         weight = param.data.cpu().numpy()
 
         # Encode
-        t0, d0 = self._huffman_encode(weight, f'{name}_data', directory)
+        t0, d0 = self._huffman_encode_block(weight, labels, f'{name}_data', store)
 
         # Print statistics
         original = param.data.cpu().numpy().nbytes
@@ -264,20 +676,14 @@ class HuffmanEncoder:
 
         return original, compressed
 
-    def _huffman_decode_fc(self, param, name, directory):
-        # Decode data
-        weight = self._huffman_decode(directory, f'{name}_data', dtype='float32')
-
-        # Reconstruct weight
-        weight = weight.reshape(param.shape)
-
-        # Return the parameters
-        param = torch.from_numpy(weight).to(param.device)
-        return param
+    def _huffman_decode_fc(self, param, name, store, out=None):
+        # Decode data (and reconstruct weight)
+        weight = np.empty(tuple(param.shape), dtype=np.float32) if out is None else out
+        return self._huffman_decode_block(store, f'{name}_data', out=weight)
 
-    def _direct_dump(self, param, name, directory):
+    def _direct_dump(self, param, name, store):
         data = param.data.cpu().numpy()
-        data.dump(f'{directory}/{name}')
+        store.write_array(name, data)
 
         # Print statistics
         original = data.nbytes
@@ -291,13 +697,81 @@ class HuffmanEncoder:
 
         return original, compressed
 
-    def _direct_load(self, param, name, directory):
-        data = np.load(f'{directory}/{name}', allow_pickle=True)
-        param = torch.from_numpy(data).to(param.device)
-        return param
+    def _direct_load(self, param, name, store, out=None):
+        data = store.read_array(name)
+        if out is None:
+            return np.array(data)  # Copy of the read-only view of a container
+        out[...] = data
+        return out
+
+    @staticmethod
+    def _open_store(directory, backend, mode):
+        """
+        backend:
+            files     : One file per encoded array in "directory"
+            container : Single indexed file "directory/CONTAINER_NAME", memory-mapped when decoding
+        """
+        if backend == 'files':
+            return DirectoryStore(directory)
+        elif backend == 'container':
+            path = Path(directory)/HuffmanEncoder.CONTAINER_NAME
+            if mode == 'w':
+                os.makedirs(directory, exist_ok=True)
+                return ContainerWriter(path)
+            return ContainerReader(path)
+        raise NameError(backend)
 
     # Encode / Decode models
-    def huffman_encode_model(self, model, directory='encodings/'):
+    def _encode_param(self, name, param, store, left, labels):
+        """ Encodes an entry of a state dict, returns its category (conv, fc or other) and its sizes """
+        if len(param.shape) == 4:
+            return ('c',) + self._huffman_encode_conv(param, name, store, {name: left}, labels)
+        elif len(param.shape) == 2:
+            return ('f',) + self._huffman_encode_fc(param, name, store, labels)
+        return ('o',) + self._direct_dump(param, name, store)
+
+    def _decode_param(self, name, param, store, out=None):
+        """ Decodes an entry of a state dict into "out" (a numpy array of the shape of "param", or None) """
+        if len(param.shape) == 4:
+            return self._huffman_decode_conv(param, name, store, out)
+        elif len(param.shape) == 2:
+            return self._huffman_decode_fc(param, name, store, out)
+        return self._direct_load(param, name, store, out)
+
+    def _decode_param_(self, name, param, store):
+        """
+        Decodes an entry of a state dict straight into the storage of "param" (a tensor of the model)
+        # The parameters on the CPU are decoded in place, the others through a buffer of the size of the parameter
+        """
+        with torch.no_grad():
+            if param.device.type == 'cpu' and param.is_contiguous():
+                self._decode_param(name, param, store, out=param.detach().numpy())
+            else:
+                param.copy_(torch.from_numpy(self._decode_param(name, param, store)))
+
+    def _encode_params(self, tasks, store):
+        """
+        Encodes the (name, param, left, labels) of "tasks" in this process, or in "n_workers" processes
+        yields their categories and sizes in the order of "tasks", the logs and the writes are done in the same order
+        """
+        if self.n_workers <= 1:
+            for name, param, left, labels in tasks:
+                yield self._encode_param(name, param, store, left, labels)
+            return
+        tasks = [(name, param.detach().cpu().numpy(), left, labels) for name, param, left, labels in tasks]
+        with ProcessPoolExecutor(self.n_workers, initializer=_init_worker,
+                                 initargs=(self.canonical, self.coders)) as executor:
+            for stats, logger, memory_store in executor.map(_encode_layer, tasks):
+                logger.replay(self.logger)
+                memory_store.replay(store)
+                yield stats
+
+    def _encode_model(self, model, store, quan_dict=None):
+        """
+        Encodes the state dict of "model" into "store" and logs the sizes
+        returns {name: (original bytes, compressed bytes)} of the entries of the state dict, and the same for the
+        categories 'Total', 'Conv', 'Fc' and 'Other'
+        """
         def get_title_text():
             return (f"{'Layer':<35} | {'original bytes':>20} {'compressed bytes':>20} {'improvement':>11} "
                     f"{'percent':>7}")
@@ -307,23 +781,19 @@ class HuffmanEncoder:
             (f"-" * 120)
         )
         self.logger.log(log_text, verbose=True)
-        os.makedirs(directory, exist_ok=True)
 
         # Start Encoding
         # NOTE: It's IMPORTANT to use state_dict() instead of named_parameters() here
         s = {'c': [0, 0], 'f': [0, 0], 'o': [0, 0], 't': [0, 0]}
         s2n = {'c': 'Conv', 'f': 'Fc', 'o': 'Other', 't': 'Total'}
         left_conv_dict = FiltersPruner.get_left_dict(model)
-        for name, param in model.state_dict().items():
-            if len(param.shape) == 4:
-                orig, comp = self._huffman_encode_conv(param, name, directory, left_conv_dict)
-                key = 'c'
-            elif len(param.shape) == 2:
-                orig, comp = self._huffman_encode_fc(param, name, directory)
-                key = 'f'
-            else:
-                orig, comp = self._direct_dump(param, name, directory)
-                key = 'o'
+        quan_dict = quan_dict or dict()
+        tasks = [(name, param, left_conv_dict.get(name),
+                  quan_dict.get(name[:-len('.weight')]) if name.endswith('.weight') else None)
+                 for name, param in model.state_dict().items()]
+        layer_sizes = dict()
+        for (name, _, _, _), (key, orig, comp) in zip(tasks, self._encode_params(tasks, store)):
+            layer_sizes[name] = (orig, comp)
             s[key][0] += orig
             s[key][1] += comp
             s['t'][0] += orig
@@ -345,15 +815,438 @@ class HuffmanEncoder:
             f"{get_text_by_key('o')}\n"
         )
         self.logger.log(log_text, verbose=True)
+        return layer_sizes, {s2n[key]: tuple(s[key]) for key in 'tcfo'}
 
-    def huffman_decode_model(self, model, directory='encodings/'):
-        state_dict = dict()
-        for name, param in model.state_dict().items():
-            if len(param.shape) == 4:
-                dec_param = self._huffman_decode_conv(param, name, directory)
-            elif len(param.shape) == 2:
-                dec_param = self._huffman_decode_fc(param, name, directory)
-            else:
-                dec_param = self._direct_load(param, name, directory)
-            state_dict[name] = dec_param
-        model.load_state_dict(state_dict)
+    def huffman_encode_model(self, model, directory='encodings/', backend='files', quan_dict=None):
+        """
+        quan_dict : Module name => Cluster indices of its weight ("PostQuantizer.get_quan_dict()"), the weights of
+                    these modules are encoded as their indices and the table of the centroids
+        returns the sizes of the entries of the state dict and of the categories (see "_encode_model")
+        """
+        store = self._open_store(directory, backend, 'w')
+        layer_sizes, sizes = self._encode_model(model, store, quan_dict)
+        file_size = store.close()
+        if file_size is not None:
+            orig = sizes['Total'][0]
+            self.logger.log(f"{'Container file':35} | {orig:>20} {file_size:>20} "
+                            f"{orig / file_size:>10.2f}x {100 * file_size / orig:>6.2f}%", verbose=True)
+        return layer_sizes, sizes
+
+    def estimate_model_size(self, model, quan_dict=None):
+        """
+        Sizes which "huffman_encode_model" would return for the same inputs, without coding the data nor writing
+        anything (nor logging)
+        # The histograms, codebooks, indices and sparse layouts are computed as by the encoder, so the sizes of the
+        # Huffman coded data (sum of the code lengths) are exact. The rANS coded data is sized by "RansCoder.get_size",
+        # within about half a byte per lane (1024 symbols). The header and the alignment of the container are not
+        # counted, as in the sizes of "huffman_encode_model".
+        """
+        return self._get_estimator()._encode_model(model, SizeStore(), quan_dict)
+
+    def estimate_param_size(self, name, param, labels=None, exact=False):
+        """
+        Compressed bytes of the entry "name" of a state dict holding "param" (see "estimate_model_size"), e.g. the
+        weight of a layer quantized to the cluster indices "labels"
+        With "exact", the data is coded (without being kept) so that the rANS coded sizes are exact too
+        """
+        left = FiltersPruner.get_left(param.data.cpu().numpy()) if len(param.shape) == 4 else None
+        return self._get_estimator(exact)._encode_param(name, param, SizeStore(), left, labels)[2]
+
+    def _get_estimator(self, exact=False):
+        """ Copy of this encoder which only measures the sizes, without logging """
+        estimator = copy.copy(self)
+        estimator.logger, estimator.n_workers, estimator.sizes_only = BufferLogger(), 1, not exact
+        return estimator
+
+    def huffman_decode_model(self, model, directory='encodings/', backend='files'):
+        state_dict = model.state_dict()
+        if self.n_workers > 1:  # Every worker opens the store
+            tasks = [(name, tuple(param.shape), param.dtype) for name, param in state_dict.items()]
+            with ProcessPoolExecutor(self.n_workers, initializer=_init_worker,
+                                     initargs=(self.canonical, self.coders, directory, backend)) as executor:
+                for (name, _, _), dec_param in zip(tasks, executor.map(_decode_layer, tasks)):
+                    with torch.no_grad():
+                        state_dict[name].copy_(torch.from_numpy(dec_param))
+        else:
+            store = self._open_store(directory, backend, 'r')
+            for name, param in state_dict.items():
+                self._decode_param_(name, param, store)
+            store.close()
+
+    def lazy_decode_model(self, model, directory='encodings/', backend='container'):
+        """
+        Decodes the parameters and the buffers of every module of "model" when the module is first called
+        returns the "LazyModelDecoder", which keeps the store open (memory-mapped for the container) until all
+        the modules are decoded
+        """
+        return LazyModelDecoder(self, model, self._open_store(directory, backend, 'r'))
+
+
+# Workers of "n_workers > 1", every process keeps its encoder (and the store to decode from)
+_worker = dict()
+
+
+def _init_worker(canonical, coders, directory=None, backend=None):
+    _worker['encoder'] = HuffmanEncoder(BufferLogger(), canonical=canonical, coders=coders)
+    if directory is not None:
+        _worker['store'] = HuffmanEncoder._open_store(directory, backend, 'r')
+
+
+def _encode_layer(task):
+    """ Encodes a layer into memory, returns its statistics and the logs and writes to replay in the main process """
+    name, param, left, labels = task
+    encoder = _worker['encoder']
+    encoder.logger = BufferLogger()
+    store = MemoryStore()
+    stats = encoder._encode_param(name, torch.from_numpy(param), store, left, labels)
+    return stats, encoder.logger, store
+
+
+def _decode_layer(task):
+    name, shape, dtype = task
+    param = torch.zeros((), dtype=dtype).expand(shape)  # Shape and dtype of the parameter without memory
+    return _worker['encoder']._decode_param(name, param, _worker['store'])
+
+
+class RansCoder:
+    """
+    Interleaved rANS coder of the symbols 0 .. K - 1 with static frequencies, vectorized over the lanes.
+    ----------------------------------------------------------
+    The symbols are laid out as a (n_steps, n_lanes) matrix, every lane (column) being a rANS state: the states are
+    updated all at once, step by step, so that the python loop runs n_steps times whatever the number of symbols.
+    The states are in [STATE_LOW, STATE_LOW << 16) and renormalized by 16-bit words. The frequencies sum to
+    1 << precision (<= 16), so that a symbol emits (or reads) at most one word per lane.
+    Payload: n_lanes (uint32), the final states (uint32 * n_lanes), the words (uint16) in the order of decoding
+    (step by step, lane by lane). Unlike Huffman coding, a symbol costs less than one bit when it is frequent.
+    ----------------------------------------------------------
+    """
+    STATE_LOW = 1 << 16
+
+    def __init__(self, precision=16, n_steps=1024):
+        assert precision <= 16
+        self.precision = precision
+        self.n_steps = n_steps  # The number of lanes grows with the number of symbols (4 bytes of state each)
+
+    def get_freqs(self, counts):
+        """ Frequencies of the symbols summing to 1 << precision (at least 1 each), None if there are too many """
+        total = 1 << self.precision
+        if len(counts) > total:
+            return None
+        freqs = np.maximum(1, counts.astype(np.int64) * total // int(np.sum(counts)))
+        excess = int(np.sum(freqs)) - total
+        if excess < 0:
+            freqs[np.argmax(counts)] -= excess
+        for i in np.argsort(-freqs, kind='stable'):  # Taken from the largest frequencies
+            if excess <= 0:
+                break
+            take = min(excess, int(freqs[i]) - 1)
+            freqs[i] -= take
+            excess -= take
+        return freqs
+
+    def get_min_size(self, counts, freqs):
+        """ Lower bound of the size of the payload coding symbols of "counts" with "freqs" """
+        bits = np.sum(counts * (self.precision - np.log2(freqs)))
+        return int(bits // 8) + 4 + 4 * self._get_layout(int(np.sum(counts)))[1]
+
+    def get_size(self, counts, freqs):
+        """
+        Estimated size of the payload of "encode" for symbols of "counts" coded with "freqs"
+        # The information of the symbols (and of the padding) is held by the 16-bit words, except about 6 bits per lane
+        # left in the final states, so the estimate is within about half a byte per lane of the actual size
+        """
+        n = int(np.sum(counts))
+        n_steps, n_lanes = self._get_layout(n)
+        bits = np.sum(counts * (self.precision - np.log2(freqs)))
+        bits += (n_steps * n_lanes - n) * (self.precision - np.log2(np.max(freqs)))  # Padding
+        return 4 + 4 * n_lanes + 2 * int(math.ceil(max(bits - 6 * n_lanes, 0) / 16))
+
+    def _get_layout(self, n):
+        n_lanes = max(1, -(-n // self.n_steps))
+        return -(-n // n_lanes), n_lanes
+
+    def encode(self, symbols, freqs):
+        n_steps, n_lanes = self._get_layout(len(symbols))
+        starts = (np.cumsum(freqs) - freqs).astype(np.int64)
+        padded = np.full(n_steps * n_lanes, np.argmax(freqs), dtype=np.int64)  # Padded with the cheapest symbol
+        padded[:len(symbols)] = symbols
+        padded = padded.reshape(n_steps, n_lanes)
+        limits = freqs.astype(np.int64) << (32 - self.precision)  # A state must be below it before coding a symbol
+        all_f, all_starts, all_limits = freqs.astype(np.int64)[padded], starts[padded], limits[padded]
+
+        x = np.full(n_lanes, self.STATE_LOW, dtype=np.int64)
+        words = list()
+        for t in range(n_steps - 1, -1, -1):  # Backwards, the decoder reads forwards
+            emit = x >= all_limits[t]
+            words.append(x[emit])
+            x = np.where(emit, x >> 16, x)
+            q = x // all_f[t]
+            x += (q << self.precision) - q * all_f[t] + all_starts[t]
+        return (np.array([n_lanes], dtype='<u4').tobytes() + x.astype('<u4').tobytes() +
+                (np.concatenate(words[::-1]) & 0xFFFF).astype('<u2').tobytes())
+
+    def decode(self, payload, freqs, n):
+        n_steps, n_lanes = self._get_layout(n)
+        assert int(payload[:4].view('<u4')[0]) == n_lanes
+        x = payload[4:4 + 4 * n_lanes].view('<u4').astype(np.int64)
+        words = payload[4 + 4 * n_lanes:].view('<u2').astype(np.int64)
+        starts = (np.cumsum(freqs) - freqs).astype(np.int64)
+        slots = np.repeat(np.arange(len(freqs)), freqs)  # Symbol of every slot
+        mask = (1 << self.precision) - 1
+
+        slot_freqs, slot_offsets = freqs[slots], np.arange(len(slots)) - starts[slots]  # Per slot
+        symbols = np.empty((n_steps, n_lanes), dtype=np.int64)
+        pos = 0
+        for t in range(n_steps):
+            slot = x & mask
+            symbols[t] = slot  # The slots are mapped to the symbols at the end
+            x = slot_freqs[slot] * (x >> self.precision) + slot_offsets[slot]
+            read = np.nonzero(x < self.STATE_LOW)[0]
+            if len(read) > 0:
+                x[read] = (x[read] << 16) | words[pos:pos + len(read)]
+                pos += len(read)
+        return slots[symbols.reshape(-1)[:n]]
+
+
+class LazyModelDecoder:
+    """
+    Decodes the entries of an encoded model into the tensors of "model", module by module when they are first used.
+    ----------------------------------------------------------
+    A forward pre-hook decodes the parameters and the buffers of a module (not of its submodules) the first time the
+    module is called, straight into their storage (see "HuffmanEncoder._decode_param_"), then removes itself. The
+    tensors of a module used without calling the module must be decoded with "materialize" first.
+    ----------------------------------------------------------
+    """
+    def __init__(self, encoder, model, store):
+        self.encoder = encoder
+        self.store = store
+        self.pending = dict()  # Module name => (Entry name, tensor) of its parameters and buffers
+        self.handles = dict()
+        for module_name, module in model.named_modules():
+            prefix = f'{module_name}.' if module_name else ''
+            tensors = [(f'{prefix}{name}', t) for name, t in list(module.named_parameters(recurse=False)) +
+                       list(module.named_buffers(recurse=False)) if t is not None]
+            if tensors:
+                self.pending[module_name] = tensors
+                self.handles[module_name] = module.register_forward_pre_hook(
+                    lambda _, __, module_name=module_name: self._decode_module(module_name))
+
+    def _decode_module(self, module_name):
+        for name, tensor in self.pending.pop(module_name):
+            self.encoder._decode_param_(name, tensor, self.store)
+        self.handles.pop(module_name).remove()
+        if not self.pending:
+            self.close()
+
+    def materialize(self, module_names=None):
+        """ Decodes the modules "module_names" (all the remaining ones by default) """
+        for module_name in list(self.pending) if module_names is None else module_names:
+            if module_name in self.pending:
+                self._decode_module(module_name)
+
+    def is_materialized(self):
+        return not self.pending
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+
+def get_canonical_codes(lengths):
+    """ Canonical codes of the code lengths "lengths" sorted in increasing order (uint64) """
+    counts = np.bincount(lengths)
+    first = np.zeros(len(counts), dtype=np.uint64)  # First code of every length
+    code = 0
+    for length in range(1, len(counts)):
+        code = (code + int(counts[length - 1])) << 1
+        first[length] = code
+    ranks = np.arange(len(lengths)) - (np.cumsum(counts) - counts)[lengths]  # Rank within the codes of its length
+    return first[lengths] + ranks.astype(np.uint64)
+
+
+class HuffmanTableDecoder:
+    """
+    Table driven decoder of prefix codes, without a bit string intermediate.
+    ----------------------------------------------------------
+    A lookup table of the next "k" bits gives the length (and the symbol) of the code starting at a bit position, the
+    codes longer than "k" bits are left to "_resolve" of the subclasses. The table is looked up at every bit
+    position at once, which gives the start of the next code of every position. The stream is then cut into blocks:
+    walking every block backwards (all blocks at once) gives where decoding from any position leaves its block, so
+    that the codes starting at position 0 are chained block by block, and marked by walking all blocks at once.
+    ----------------------------------------------------------
+    """
+    def __init__(self, codes, lengths, max_k=16, block_size=256):
+        self.block_size = block_size
+        self.max_len = int(np.max(lengths))
+        self.k = min(self.max_len, max_k)
+
+        # Table of the next k bits: the length of the code (0 if longer) and its symbol
+        short = np.nonzero(lengths <= self.k)[0]
+        spans = 1 << (self.k - lengths[short])
+        entries = np.repeat(codes[short] << (self.k - lengths[short]), spans) + \
+            np.arange(int(np.sum(spans))) - np.repeat(np.cumsum(spans) - spans, spans)
+        self.tab_len = np.zeros(1 << self.k, dtype=np.uint8)
+        self.tab_sym = np.zeros(1 << self.k, dtype=np.int64)
+        self.tab_len[entries] = np.repeat(lengths[short], spans)
+        self.tab_sym[entries] = np.repeat(short, spans)
+
+    def _get_windows(self, padded, n_bits):
+        """ The next k bits of every bit position """
+        v = (padded[:-2] << 16) | (padded[1:-1] << 8) | padded[2:]  # The next 24 bits of every byte
+        shifts = (24 - self.k - np.arange(8)).astype(np.uint32)
+        return ((v[:, None] >> shifts) & ((1 << self.k) - 1)).astype(np.uint16).reshape(-1)[:n_bits]
+
+    def _resolve(self, padded, positions, lens, syms):
+        """ Lengths and symbols of the codes longer than k bits (lens == 0) starting at "positions" """
+        raise NotImplementedError
+
+    def decode(self, data, n_bits):
+        """
+        Decodes the first "n_bits" bits of "data" (uint8 array)
+        returns the leaves of the decoded codes
+        """
+        if n_bits == 0:
+            return np.zeros(0, dtype=np.int64)
+        size = max(self.block_size, 2 * self.max_len)  # A code is shorter than a block
+        n_blocks = -(-n_bits // size)
+        padded = np.concatenate((data[:(n_bits + 7) // 8], np.zeros(self.max_len // 8 + 8, dtype=np.uint8)))
+        padded = padded.astype(np.uint32)
+
+        # Start of the next code of every bit position, relative to its block
+        windows = self._get_windows(padded, n_bits)
+        lens = np.full(n_blocks * size, size, dtype=np.int32)  # The positions past the end leave their block
+        lens[:n_bits] = self.tab_len[windows]
+        if self.k < self.max_len:
+            positions = np.nonzero(lens[:n_bits] == 0)[0]
+            lens[positions] = self._resolve(padded, positions, lens[positions], self.tab_sym[windows[positions]])[0]
+        # Offset major (size + max_len, n_blocks) layout: a row holds the same offset of all blocks, and the rows past
+        # the end of the blocks exit to themselves. "jumps" holds the flat index of the next code
+        n_rows = size + self.max_len
+        index_dtype = np.int32 if n_rows * n_blocks < 2 ** 31 else np.int64
+        cols = np.arange(n_blocks, dtype=index_dtype)
+        jumps = lens.reshape(n_blocks, size).T.astype(index_dtype)
+        jumps += np.arange(size, dtype=index_dtype)[:, None]
+        np.minimum(jumps, n_rows - 1, out=jumps)
+        jumps *= n_blocks
+        jumps += cols
+        exits = np.empty(n_rows * n_blocks, dtype=index_dtype)
+        exits[size * n_blocks:] = np.arange(size * n_blocks, len(exits))
+
+        # exits[o, b] : Start of the first code at or after the end of block b when decoding from its offset o
+        for offset in range(size - 1, -1, -1):
+            exits[offset * n_blocks:(offset + 1) * n_blocks] = exits[jumps[offset]]
+
+        # Chain the blocks from position 0
+        entries = np.zeros(n_blocks, dtype=index_dtype)
+        entry = 0
+        for b in range(n_blocks - 1):
+            entry = int(exits[entry * n_blocks + b]) // n_blocks - size
+            entries[b + 1] = entry
+
+        # Mark the starts of the codes of every block, walking the flat indices
+        limits = np.minimum(np.arange(1, n_blocks + 1) * size, n_bits) - np.arange(n_blocks) * size
+        limits = limits.astype(index_dtype)
+        is_start = np.zeros(size * n_blocks, dtype=bool)
+        flat_jumps = jumps.reshape(-1)
+        f, thresholds = entries * n_blocks + cols, limits * n_blocks + cols
+        active = f < thresholds
+        while np.any(active):
+            f, thresholds = f[active], thresholds[active]
+            is_start[f] = True
+            f = flat_jumps[f]
+            active = f < thresholds
+        is_start = is_start.reshape(size, n_blocks).T.reshape(-1)
+
+        starts = np.nonzero(is_start[:n_bits])[0]
+        syms = self.tab_sym[windows[starts]]
+        if self.k < self.max_len:
+            syms = self._resolve(padded, starts, self.tab_len[windows[starts]].astype(np.int64), syms)[1]
+        return syms
+
+
+class HuffmanTreeDecoder(HuffmanTableDecoder):
+    """ Decoder of the codes of a huffman tree, the codes longer than k bits continue from the node at depth k """
+    def __init__(self, children, max_k=16, block_size=256):
+        self.children = children
+
+        # Codes of the leaves and the internal nodes at depth "max_k"
+        n_leaves = len(children) + 1
+        lengths = np.zeros(n_leaves, dtype=np.int64)
+        codes = np.zeros(n_leaves, dtype=np.int64)
+        deep_nodes = list()  # (Internal node, code) at depth "max_k"
+        stack = [(0, 0, 0)]
+        while stack:
+            node, code, length = stack.pop()
+            if node < 0:
+                codes[~node], lengths[~node] = code, length
+                continue
+            if length == max_k:
+                deep_nodes.append((node, code))
+            for side in (1, 0):
+                stack.append((children[node, side], (code << 1) | side, length + 1))
+        super().__init__(codes, lengths, max_k, block_size)
+        for node, code in deep_nodes:
+            self.tab_sym[code] = node
+
+    def _resolve(self, padded, positions, lens, syms):
+        """ Walks the tree from the nodes at depth k, one bit at a time """
+        todo = np.nonzero(lens == 0)[0]
+        node = syms[todo]
+        depth = self.k
+        while len(todo) > 0:
+            q = positions[todo] + depth
+            bit = (padded[q >> 3] >> (7 - (q & 7)).astype(np.uint32)) & 1
+            child = self.children[node, bit]
+            is_leaf = child < 0
+            lens[todo[is_leaf]] = depth + 1
+            syms[todo[is_leaf]] = ~child[is_leaf]
+            todo, node = todo[~is_leaf], child[~is_leaf]
+            depth += 1
+        return lens, syms
+
+
+class CanonicalHuffmanDecoder(HuffmanTableDecoder):
+    """
+    Decoder of canonical codes, only the code lengths (of the symbols sorted by length) are needed.
+    ----------------------------------------------------------
+    The canonical codes of a length are consecutive, and the codes left-justified to the max length increase with
+    the length, so the length of the code at the start of a max length window is found by a binary search and its
+    symbol is the offset of the window from the first code of that length.
+    ----------------------------------------------------------
+    """
+    def __init__(self, lengths, max_k=16, block_size=256):
+        lengths = np.asarray(lengths, dtype=np.int64)
+        codes = get_canonical_codes(lengths).astype(np.int64)
+        super().__init__(codes, lengths, max_k, block_size)
+        assert self.max_len <= 57, 'Codes longer than 57 bits are not supported'
+        counts = np.bincount(lengths, minlength=self.max_len + 1)
+        lengths_range = np.arange(self.max_len + 1)
+        self.offsets = np.cumsum(counts) - counts  # First symbol of every length
+        self.first = np.zeros(self.max_len + 1, dtype=np.uint64)
+        self.first[lengths_range[counts > 0]] = codes[self.offsets[counts > 0]].astype(np.uint64)
+        # End of the codes of every length, left-justified. For the lengths without codes it is the one of the
+        # previous length so that the ends keep increasing
+        ends = np.zeros(self.max_len + 1, dtype=np.uint64)
+        end = 0
+        for length in range(1, self.max_len + 1):
+            if counts[length] > 0:
+                end = (int(self.first[length]) + int(counts[length])) << (self.max_len - length)
+            ends[length] = end
+        self.ends = ends[1:]
+        self.n_symbols = len(lengths)
+
+    def _resolve(self, padded, positions, lens, syms):
+        """ Finds the length of the codes in the max length windows """
+        todo = np.nonzero(lens == 0)[0]
+        q = positions[todo].astype(np.int64)
+        v = np.zeros(len(q), dtype=np.uint64)
+        for i in range(8):  # The 8 bytes from the byte of every position
+            v = (v << np.uint64(8)) | padded[(q >> 3) + i].astype(np.uint64)
+        windows = (v << (q & 7).astype(np.uint64)) >> np.uint64(64 - self.max_len)
+        length = np.minimum(np.searchsorted(self.ends, windows, side='right') + 1, self.max_len)
+        shifts = (self.max_len - length).astype(np.uint64)
+        sym = self.offsets[length] + ((windows >> shifts) - self.first[length]).astype(np.int64)
+        lens[todo] = length
+        syms[todo] = np.clip(sym, 0, self.n_symbols - 1)  # The windows off the path of the codes may be anywhere
+        return lens, syms
@@ -0,0 +1,253 @@
+import copy
+
+import torch
+import torch.nn as nn
+
+from models.alexnet import AlexNet
+from models.cifar_resnet import CifarResNet, ResNetBasicblock
+from models.imagenet_resnet import ResNet, BasicBlock, Bottleneck
+from models.resnet_utils import DownsampleA
+from models.compact import CompactBlock, CompactResNet
+from models.shared import SharedConv2d, SharedLinear
+
+
+class CompactExporter(object):
+    """
+    Builds a narrower model from a pruned model by physically removing the pruned filters (and the input channels
+    of the next layers which consume them).
+    ----------------------------------------------------------
+    A filter is considered as pruned if it is masked out by "conv_mask" (see "FiltersPruner.get_conv_mask()"), or,
+    without "conv_mask", if the filter and its BatchNorm2d entries are all zeros.
+    ----------------------------------------------------------
+    """
+    def __init__(self, logger):
+        self.logger = logger
+
+    @staticmethod
+    def _get_keep_indices(name, conv, bn, conv_mask):
+        n_f = conv.weight.shape[0]
+        if conv_mask is not None and name in conv_mask:
+            alive = torch.sum(conv_mask[name].reshape(n_f, -1) != 0, dim=1) != 0
+        else:
+            alive = torch.sum(conv.weight.data.reshape(n_f, -1) != 0, dim=1) != 0
+            if conv.bias is not None:
+                alive |= conv.bias.data != 0
+            if bn is not None and bn.affine:
+                alive |= (bn.weight.data != 0) | (bn.bias.data != 0)
+        keep = torch.nonzero(alive.cpu()).reshape(-1)
+        if len(keep) == 0:
+            raise ValueError(f'All filters of {name} are pruned')
+        return keep
+
+    @staticmethod
+    def _slice_conv(conv, out_idx, in_idx):
+        assert conv.groups == 1, 'Grouped convolutions are not supported'
+        new_conv = nn.Conv2d(len(in_idx), len(out_idx), kernel_size=conv.kernel_size, stride=conv.stride,
+                             padding=conv.padding, dilation=conv.dilation, bias=conv.bias is not None)
+        w = conv.weight.data
+        new_conv.weight.data = w[out_idx.to(w.device)][:, in_idx.to(w.device)].clone()
+        if conv.bias is not None:
+            new_conv.bias.data = conv.bias.data[out_idx.to(w.device)].clone()
+        return new_conv
+
+    @staticmethod
+    def _slice_bn(bn, idx):
+        new_bn = nn.BatchNorm2d(len(idx), eps=bn.eps, momentum=bn.momentum, affine=bn.affine,
+                                track_running_stats=bn.track_running_stats)
+        idx = idx.to(bn.running_mean.device if bn.track_running_stats else bn.weight.device)
+        if bn.affine:
+            new_bn.weight.data = bn.weight.data[idx].clone()
+            new_bn.bias.data = bn.bias.data[idx].clone()
+        if bn.track_running_stats:
+            new_bn.running_mean.data = bn.running_mean.data[idx].clone()
+            new_bn.running_var.data = bn.running_var.data[idx].clone()
+            new_bn.num_batches_tracked.data = bn.num_batches_tracked.data.clone()
+        return new_bn
+
+    @staticmethod
+    def _slice_linear(fc, n_c, in_idx):
+        # --------------------------------------------
+        # The input of "fc" is a flattened (n_c, h, w) feature map
+        # --------------------------------------------
+        new_fc = nn.Linear(len(in_idx) * (fc.in_features // n_c), fc.out_features, bias=fc.bias is not None)
+        w = fc.weight.data.reshape(fc.out_features, n_c, -1)
+        new_fc.weight.data = w[:, in_idx.to(w.device)].reshape(fc.out_features, -1).clone()
+        if fc.bias is not None:
+            new_fc.bias.data = fc.bias.data.clone()
+        return new_fc
+
+    @staticmethod
+    def _get_block_layers(block):
+        if isinstance(block, ResNetBasicblock):
+            return [(block.conv_a, block.bn_a), (block.conv_b, block.bn_b)]
+        elif isinstance(block, BasicBlock):
+            return [(block.conv1, block.bn1), (block.conv2, block.bn2)]
+        elif isinstance(block, Bottleneck):
+            return [(block.conv1, block.bn1), (block.conv2, block.bn2), (block.conv3, block.bn3)]
+        raise NotImplementedError(type(block))
+
+    def _export_block(self, block, names, in_idx, conv_mask):
+        """
+        # in_idx : Indices of the channels of the residual stream which may be nonzero before the block
+        """
+        body = list()
+        idx = in_idx
+        for conv, bn in self._get_block_layers(block):
+            out_idx = self._get_keep_indices(names[conv], conv, bn, conv_mask)
+            body += [self._slice_conv(conv, out_idx, idx), self._slice_bn(bn, out_idx), nn.ReLU(inplace=True)]
+            idx = out_idx
+        body = nn.Sequential(*body[:-1])  # No ReLU before the residual addition
+        body_idx = idx
+
+        # Shortcut
+        if block.downsample is None:
+            shortcut = None
+            res_idx = in_idx
+        elif isinstance(block.downsample, DownsampleA):
+            # Avg-pooling followed by zero padding, the channels of the input keep their indices
+            shortcut = copy.deepcopy(block.downsample.avg)
+            res_idx = in_idx
+        else:
+            ds_conv, ds_bn = block.downsample[0], block.downsample[1]
+            res_idx = self._get_keep_indices(names[ds_conv], ds_conv, ds_bn, conv_mask)
+            shortcut = nn.Sequential(self._slice_conv(ds_conv, res_idx, in_idx), self._slice_bn(ds_bn, res_idx))
+
+        # The output stream holds the channels of the shortcut and the body
+        out_idx = torch.unique(torch.cat((res_idx, body_idx)))  # Sorted
+        compact_block = CompactBlock(
+            body, shortcut, torch.searchsorted(out_idx, res_idx), torch.searchsorted(out_idx, body_idx), len(out_idx)
+        )
+        return compact_block, out_idx
+
+    def _export_resnet(self, model, conv_mask):
+        names = {module: name for name, module in model.named_modules()}
+        if isinstance(model, CifarResNet):
+            conv, bn = model.conv_1_3x3, model.bn_1
+            stages = [model.stage_1, model.stage_2, model.stage_3]
+            fc = model.classifier
+        else:
+            conv, bn = model.conv1, model.bn1
+            stages = [model.layer1, model.layer2, model.layer3, model.layer4]
+            fc = model.fc
+
+        idx = self._get_keep_indices(names[conv], conv, bn, conv_mask)
+        stem = [self._slice_conv(conv, idx, torch.arange(conv.in_channels)), self._slice_bn(bn, idx),
+                nn.ReLU(inplace=True)]
+        if isinstance(model, ResNet):
+            stem.append(copy.deepcopy(model.maxpool))
+
+        blocks = list()
+        for stage in stages:
+            for block in stage:
+                compact_block, idx = self._export_block(block, names, idx, conv_mask)
+                blocks.append(compact_block)
+
+        return CompactResNet(
+            nn.Sequential(*stem), nn.Sequential(*blocks), copy.deepcopy(model.avgpool),
+            self._slice_linear(fc, fc.in_features, idx)
+        )
+
+    def _export_alexnet(self, model, conv_mask):
+        compact_model = copy.deepcopy(model)
+        idx = torch.arange(model.conv1.in_channels)
+        for i in range(1, 6):
+            name = f'conv{i}'
+            conv, bn = getattr(model, name), getattr(model, f'{name}_bn')
+            out_idx = self._get_keep_indices(name, conv, bn, conv_mask)
+            setattr(compact_model, name, self._slice_conv(conv, out_idx, idx))
+            setattr(compact_model, f'{name}_bn', self._slice_bn(bn, out_idx))
+            idx = out_idx
+        compact_model.fc1 = self._slice_linear(model.fc1, model.conv5.out_channels, idx)
+        return compact_model
+
+    def export(self, model, conv_mask=None):
+        if isinstance(model, (CifarResNet, ResNet)):
+            compact_model = self._export_resnet(model, conv_mask)
+        elif isinstance(model, AlexNet):
+            compact_model = self._export_alexnet(model, conv_mask)
+        else:
+            raise NotImplementedError(type(model))
+        compact_model = compact_model.to(next(model.parameters()).device)
+
+        n_orig = sum(p.numel() for p in model.parameters())
+        n_comp = sum(p.numel() for p in compact_model.parameters())
+        self.logger.log(f'Compact export : params {n_orig} => {n_comp} ({100 * n_comp / n_orig:6.2f}%)', verbose=True)
+        return compact_model
+
+    @staticmethod
+    def _get_masked_model(model, conv_mask):
+        """ Copy of "model" with the masked filters (and their BatchNorm2d entries) set to zero """
+        masked_model = copy.deepcopy(model)
+        prune_indices = None
+        for name, module in masked_model.named_modules():
+            if isinstance(module, nn.Conv2d):
+                prune_indices = None
+                if name in conv_mask:
+                    mask = conv_mask[name].to(module.weight.device)
+                    module.weight.data *= mask
+                    alive = torch.sum(mask.reshape(mask.shape[0], -1) != 0, dim=1) != 0
+                    prune_indices = torch.nonzero(~alive).reshape(-1)
+                    if module.bias is not None:
+                        module.bias.data[prune_indices] = 0.
+            elif isinstance(module, nn.BatchNorm2d) and prune_indices is not None and module.affine:
+                module.weight.data[prune_indices] = 0.
+                module.bias.data[prune_indices] = 0.
+        return masked_model
+
+    def check_parity(self, model, compact_model, input, conv_mask=None):
+        """
+        Compares the outputs of the masked model and the compact model on the same input
+        returns the max absolute difference of the logits
+        """
+        if conv_mask is not None:
+            model = self._get_masked_model(model, conv_mask)
+        is_trainings = model.training, compact_model.training
+        model.eval()
+        compact_model.eval()
+        with torch.no_grad():
+            out = model(input)
+            compact_out = compact_model(input)
+        model.train(is_trainings[0])
+        compact_model.train(is_trainings[1])
+        max_diff = torch.max(torch.abs(out - compact_out)).item()
+        self.logger.log(f'Compact export : max abs logit difference to the masked model = {max_diff:.3e}',
+                        verbose=True)
+        return max_diff
+
+
+class SharedExporter(object):
+    """
+    Builds a model computing its quantized layers from the shared values of their weights ("SharedConv2d" and
+    "SharedLinear", uint8 or int16 indices into a table of centroids) instead of dense float weights.
+    ----------------------------------------------------------
+    The quantized layers are the modules of "quan_dict" ("PostQuantizer.get_quan_dict()"), whose weights must be
+    the centroids of their cluster indices. The outputs are the same as the outputs of the model.
+    ----------------------------------------------------------
+    """
+    def __init__(self, logger):
+        self.logger = logger
+
+    @staticmethod
+    def get_nbytes(model):
+        return sum(t.nelement() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+
+    def export(self, model, quan_dict, max_elems=1 << 22):
+        """ max_elems : Dense weights gathered at once by a layer (see "_SharedWeight") """
+        shared_model = copy.deepcopy(model)
+        modules = dict(shared_model.named_modules())
+        for name, labels in quan_dict.items():
+            module = modules[name]
+            if isinstance(module, nn.Conv2d):
+                shared = SharedConv2d(module, labels, max_elems)
+            elif isinstance(module, nn.Linear):
+                shared = SharedLinear(module, labels, max_elems)
+            else:
+                raise NotImplementedError(type(module))
+            parent_name, _, attr = name.rpartition('.')
+            setattr(modules[parent_name], attr, shared.to(module.weight.device))
+
+        n_dense, n_shared = self.get_nbytes(model), self.get_nbytes(shared_model)
+        self.logger.log(f'Shared export : {len(quan_dict)} layers | bytes {n_dense} => {n_shared} '
+                        f'({100 * n_shared / n_dense:6.2f}%)', verbose=True)
+        return shared_model
+
@@ -0,0 +1,204 @@
+import inspect
+import operator
+from collections import defaultdict
+
+import numpy as np
+
+import torch
+import torch.fx as fx
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class _LeafTracer(fx.Tracer):
+    """ Keeps the layers carrying channels as single nodes of the graph """
+    def is_leaf_module(self, m, module_qualified_name):
+        return isinstance(m, (nn.Conv2d, nn.BatchNorm2d, nn.Linear)) or super().is_leaf_module(m, module_qualified_name)
+
+
+class DependencyGraph(object):
+    """
+    Coupled output channels of the conv layers of a model, derived from its torch.fx graph.
+    ----------------------------------------------------------
+    Every output channel of every conv layer is an element of a union-find. The channels of each tensor of the graph
+    are tracked as the array of the elements they come from (-1 : always zero, e.g. the padding of "DownsampleA"),
+    and the channels summed by a residual addition are merged. A component (unit) of the union-find is a set of
+    filters which must be pruned together for the pruned channels to be removable, and the conv layers sharing
+    units form a layer group.
+    ----------------------------------------------------------
+    """
+    PASS_MODULES = (nn.BatchNorm2d, nn.ReLU, nn.MaxPool2d, nn.AvgPool2d, nn.AdaptiveAvgPool2d, nn.Dropout,
+                    nn.Identity)
+    PASS_FUNCTIONS = (F.relu, F.max_pool2d, F.avg_pool2d, F.adaptive_avg_pool2d, F.dropout, torch.flatten,
+                      operator.getitem)
+    PASS_METHODS = ('relu', 'relu_', 'view', 'reshape', 'flatten', 'contiguous')
+    ADD_FUNCTIONS = (operator.add, operator.iadd, torch.add)
+
+    def __init__(self, model):
+        self.model = model
+        self.convs = [(name, module) for name, module in model.named_modules() if isinstance(module, nn.Conv2d)]
+        self.offsets = dict()  # Layer name => Element of its first filter
+        self.n_filters = {name: module.out_channels for name, module in self.convs}
+        n = 0
+        for name, module in self.convs:
+            assert module.groups == 1, 'Grouped convolutions are not supported'
+            self.offsets[name] = n
+            n += module.out_channels
+        self.parent = np.arange(n)
+        self.pinned = np.zeros(n, dtype=bool)  # Channels consumed by unsupported ops, never pruned
+        self.inputs = dict()  # Name of a conv / linear layer => Elements of its input channels (None : model input)
+        self._trace()
+        self.roots = self._find(np.arange(n))
+        self.pinned = np.bincount(self.roots, weights=self.pinned, minlength=n)[self.roots] > 0
+        self.layer_groups = self._get_layer_groups()
+
+    def _find(self, x):
+        # Pointer jumping, the roots are the smallest elements of the components
+        p = self.parent[x]
+        while True:
+            pp = self.parent[p]
+            if np.array_equal(pp, p):
+                return p
+            p = pp
+
+    def _union(self, a, b):
+        while True:
+            ra, rb = self._find(a), self._find(b)
+            diff = ra != rb
+            if not diff.any():
+                return
+            self.parent[np.maximum(ra, rb)[diff]] = np.minimum(ra, rb)[diff]
+
+    def _pin(self, elems):
+        if elems is not None:
+            self.pinned[elems[elems >= 0]] = True
+
+    def _trace(self):
+        # The extra arguments of "forward" (e.g. "is_group_feat") are fixed to their defaults
+        params = list(inspect.signature(self.model.forward).parameters.values())[1:]
+        concrete_args = {p.name: p.default for p in params if p.default is not inspect.Parameter.empty}
+        graph = _LeafTracer().trace(self.model, concrete_args=concrete_args or None)
+        modules = dict(self.model.named_modules())
+
+        chans = dict()  # Node => Elements of its channels, None for the tensors not derived from any conv layer
+
+        def get(arg):
+            return chans.get(arg) if isinstance(arg, fx.Node) else None
+
+        for node in graph.nodes:
+            nodes = [arg for arg in node.args if isinstance(arg, fx.Node)]
+            elems = [get(arg) for arg in nodes]
+            first = elems[0] if elems else None
+            out = None
+            if node.op == 'call_module':
+                module = modules[node.target]
+                if isinstance(module, nn.Conv2d):
+                    self.inputs[node.target] = first
+                    out = self.offsets[node.target] + np.arange(module.out_channels)
+                elif isinstance(module, nn.Linear):
+                    self.inputs[node.target] = first
+                elif isinstance(module, self.PASS_MODULES):
+                    out = first
+                else:
+                    list(map(self._pin, elems))
+            elif node.op == 'call_function' and node.target in self.ADD_FUNCTIONS or \
+                    node.op == 'call_method' and node.target in ('add', 'add_'):
+                out = self._merge(elems)
+            elif node.op == 'call_function' and node.target is torch.cat:
+                out = self._concat(node, [get(arg) for arg in node.args[0]])
+            elif node.op == 'call_function' and node.target in self.PASS_FUNCTIONS or \
+                    node.op == 'call_method' and node.target in self.PASS_METHODS:
+                out = first
+            elif node.op == 'call_method' and node.target in ('mul', 'mul_') and len(node.args) == 2 and \
+                    not isinstance(node.args[1], fx.Node):
+                out = None if first is None else (first if node.args[1] != 0 else np.full(len(first), -1))
+            elif node.op == 'call_method' and node.target == 'size':
+                pass
+            elif node.op in ('call_function', 'call_method'):
+                list(map(self._pin, elems))
+            chans[node] = out
+
+    def _merge(self, elems):
+        """ Channels of the sum of tensors: the elements summed at the same channel are merged """
+        if any(e is None for e in elems):
+            list(map(self._pin, elems))  # Coupled to channels which cannot be pruned
+            return None
+        out = elems[0].copy()
+        for e in elems[1:]:
+            both = (out >= 0) & (e >= 0)
+            self._union(out[both], e[both])
+            out = np.where(out >= 0, out, e)
+        return out
+
+    def _concat(self, node, elems):
+        dim = node.args[1] if len(node.args) > 1 else node.kwargs.get('dim', 0)
+        if dim != 1 or any(e is None for e in elems):
+            list(map(self._pin, elems))
+            return None
+        return np.concatenate(elems)
+
+    def _get_layer_groups(self):
+        # Conv layers sharing a unit are in the same layer group, led by its first layer
+        leader = list(range(len(self.convs)))
+
+        def find(i):
+            while leader[i] != i:
+                i = leader[i]
+            return i
+
+        owner = dict()  # Unit => First layer having a filter in it
+        for i, (name, _) in enumerate(self.convs):
+            for r in np.unique(self.get_roots(name)):
+                if r in owner:
+                    a, b = find(owner[r]), find(i)
+                    leader[max(a, b)] = min(a, b)
+                else:
+                    owner[r] = i
+        layer_groups = defaultdict(list)
+        for i, (name, _) in enumerate(self.convs):  # In the order of the layers
+            layer_groups[find(i)].append(name)
+        return list(layer_groups.values())
+
+    def get_roots(self, name):
+        """ Units of the filters of the conv layer "name" """
+        return self.roots[self.offsets[name]:self.offsets[name] + self.n_filters[name]]
+
+    def get_group_prune_indices(self, f_scores, prune_rates):
+        """
+        Prune indices of every conv layer, selected unit by unit within every layer group
+        --------------------------------------------
+        f_scores : Layer name => Scores of its filters (n_f,)
+        prune_rates : Layer name => Prune rate, the rate of the first layer of a layer group applies to the group
+        --------------------------------------------
+        # The score of a unit is the sum of the scores of its filters, each divided by the mean score of its layer so
+        # that the layers of different scales weigh the same. For a layer group of a single layer (which has no
+        # coupled channels) this is the same selection as "get_prune_indices"
+        """
+        prune_indices = dict()
+        for group in self.layer_groups:
+            roots = np.concatenate([self.get_roots(name) for name in group])
+            scores = list()
+            for name in group:
+                s = f_scores[name].detach().double().cpu().numpy()
+                mean = np.mean(s)
+                scores.append(s / mean if mean > 0 else s)
+            units, inverse = np.unique(roots, return_inverse=True)
+            unit_scores = np.bincount(inverse, weights=np.concatenate(scores))
+            prunable = ~self.pinned[units]
+            n_prune = int(round(np.sum(prunable) * (1.0 - prune_rates[group[0]])))
+            order = np.argsort(np.where(prunable, unit_scores, np.inf), kind='stable')
+            pruned_units = np.zeros(len(units), dtype=bool)
+            pruned_units[order[:n_prune]] = True
+            for name in group:
+                prune_indices[name] = np.nonzero(pruned_units[np.searchsorted(units, self.get_roots(name))])[0]
+        return prune_indices
+
+    def log_groups(self, logger):
+        n_coupled = 0
+        for group in self.layer_groups:
+            if len(group) > 1:
+                n_coupled += 1
+                n_units = len(np.unique(np.concatenate([self.get_roots(name) for name in group])))
+                logger.log(f'Coupled group ({len(group)} layers, {n_units} units) : {group}')
+        logger.log(f'Dependency graph : {len(self.convs)} conv layers | {len(self.layer_groups)} layer groups '
+                   f'({n_coupled} coupled) | {int(np.sum(self.pinned))} pinned filters', verbose=True)
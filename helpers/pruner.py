@@ -1,9 +1,13 @@
+import math
+from collections import defaultdict
+
 import numpy as np
 
 import torch
 import torch.nn as nn
 
-from helpers.utils import min_max_scalar
+from helpers.graph import DependencyGraph
+from helpers.scorer import get_filter_scores, get_prune_indices, is_sketch_cheaper
 
 
 class FiltersPruner(object):
@@ -16,7 +20,14 @@ class FiltersPruner(object):
                  samp_batches=None,
                  device='cuda',
                  use_actPR=False,
-                 use_greedy=False):
+                 use_greedy=False,
+                 stream_grad=False,
+                 max_stream_bytes=None,
+                 saliency=None,
+                 gm_approx=None,
+                 gm_eps=0.3,
+                 rescore_threshold=None,
+                 group_prune=False):
         super(FiltersPruner, self).__init__()
         self.model = model
         self.optimizer = optimizer
@@ -27,82 +38,146 @@ class FiltersPruner(object):
         self.device = device
         self.use_actPR = use_actPR
         self.use_greedy = use_greedy
+        self.stream_grad = stream_grad  # Accumulate the gradients batch by batch on "device"
+        self.max_stream_bytes = max_stream_bytes  # Memory ceiling of the inputs of a streamed forward/backward pass
+        self.saliency = saliency  # "GradSaliency" accumulated by the trainer, replaces the gradients of sampled batches
+        self.gm_approx = gm_approx  # Method of "get_approx_gm_dists", None for the exact GM distances
+        self.gm_eps = gm_eps
+        self.rescore_threshold = rescore_threshold  # Relative weight movement under which a layer is not rescored
+        self.graph = None  # "DependencyGraph" of the coupled channels, the filters are selected per group if given
+        if group_prune:
+            self.graph = DependencyGraph(model)
+            self.graph.log_groups(logger)
+        if gm_approx == 'sketch':
+            self._log_sketch_fallbacks()
 
         self.cross_entropy = nn.CrossEntropyLoss()
-        self.conv_mask = dict()
+        self.cross_entropy_sum = nn.CrossEntropyLoss(reduction='sum')
+        self.filter_mask = dict()  # Boolean masks of the filters (False : pruned)
+        self.channel_mask = dict()  # Boolean masks of the input channels (False : pruned)
+        self.conv_shape = dict()
         self.use_grad = False
+        self.samp_iter = None  # Persistent iterator of "train_loader" for streaming
+        self.prune_history = dict()  # Layer name => Prune indices of the last pruning
+        self.score_weights = dict()  # Layer name => Weight at the last scoring
+        self.score_rates = dict()  # Layer name => Prune rate at the last scoring
+        self.churn_stats = dict()
+
+    def _log_sketch_fallbacks(self):
+        # The layers for which the sketch is not cheaper than the pairwise distances get the exact GM distances
+        exact = [name for name, module in self.model.named_modules() if isinstance(module, nn.Conv2d) and
+                 not is_sketch_cheaper(module.out_channels, module.weight[0].numel(), self.gm_eps)]
+        n_convs = sum(isinstance(module, nn.Conv2d) for module in self.model.modules())
+        self.logger.log(f'Sketch GM distances (eps {self.gm_eps}) : {n_convs - len(exact)} / {n_convs} conv layers '
+                        f'sketched, exact distances for {exact}')
+
+    def _use_saliency(self):
+        return self.saliency is not None and self.saliency.is_ready()
+
+    def _get_weight_and_grad(self, name, module):
+        n_f = module.weight.shape[0]
+        f_w = module.weight.data.reshape(n_f, -1)  # The weight of filters
+        f_g = None
+        if self._get_use_grad():
+            if self._use_saliency():
+                f_g = self.saliency.get(name).reshape(n_f, -1)  # The |gradient| statistic of filters
+            else:
+                f_g = module.weight.grad.data.reshape(n_f, -1)  # The gradient of filters
+        return f_w, f_g
 
     def _get_prune_indices(self, name, module, prune_rate, mode='filter-a'):
-        f_w = module.weight.data.cpu().numpy()  # The weight of filters
+        f_w, f_g = self._get_weight_and_grad(name, module)
         n_f = f_w.shape[0]
-        f_w = f_w.reshape(n_f, -1)
-
-        f_g = None
-        if self._get_use_grad():
-            f_g = module.weight.grad.data.cpu().numpy()  # The gradient of filters
-            f_g = f_g.reshape(n_f, -1)
-
-        # ------------------------------------
-        # In mode:
-        #    -g- : Combine gradients
-        #    -n- : Combine min-max-scalar
-        #    -a  : Use activation-base
-        #    -gm : Use geometric-median-base
-        # ------------------------------------
-
-        def get_gm_dists(arr):
-            # --------------------------------------------
-            # Shape of arr : (n_f, n_c * h * w)
-            # --------------------------------------------
-            return np.array([np.sum(np.power(ele - arr, 2)) for ele in arr])  # (n_f,)
-
-        def get_l1_scores(arr):
-            # --------------------------------------------
-            # Shape of arr: (n_f, n_c * h * w)
-            # --------------------------------------------
-            return np.sum(np.abs(arr), axis=1)  # (n_f,)
-
-        if 'filter-a' in mode:
-            f_scores = get_l1_scores(f_w)
-        elif 'filter-g-a' in mode:
-            f_scores = np.sum(np.abs(f_w) * np.abs(f_g), axis=1)
-        elif 'filter-n-g-a' in mode:
-            f_scores = np.sum(min_max_scalar(np.abs(f_w)) + min_max_scalar(np.abs(f_g)), axis=1)
-        elif 'filter-n-g-a-2' in mode:
-            f_scores = min_max_scalar(get_l1_scores(f_w)) + min_max_scalar(get_l1_scores(f_g))
-        elif 'filter-gm' in mode:
-            f_scores = get_gm_dists(f_w)
-        elif 'filter-g-gm-1' in mode:
-            f_scores = get_gm_dists(f_w) * get_l1_scores(f_g)
-        elif 'filter-g-gm-2' in mode:
-            f_scores = get_gm_dists(f_w) + get_l1_scores(f_g)
-        elif 'filter-g-gm-3' in mode:
-            f_scores = get_gm_dists(f_w) * get_l1_scores(f_g) * get_l1_scores(f_w)
-        elif 'filter-n-g-gm-1' in mode:
-            f_scores = (
-                self.gamma * min_max_scalar(get_gm_dists(f_w)) + (1 - self.gamma) * min_max_scalar(get_l1_scores(f_g))
-            )
-        elif 'filter-n-g-gm-2' in mode:
-            f_scores = (min_max_scalar(get_gm_dists(f_w)) + min_max_scalar(get_l1_scores(f_g)) +
-                        min_max_scalar(get_l1_scores(f_w)))
-        elif 'filter-n-g-gm-3' in mode:
-            f_scores = min_max_scalar(get_gm_dists(f_w)) * min_max_scalar(get_l1_scores(f_g))
-        elif 'filter-r' in mode:
-            f_scores = np.random.rand(n_f)
-        else:
-            raise NameError
-        rank_indices = np.argsort(f_scores)
+        r = torch.from_numpy(np.random.rand(1, n_f)).to(f_w.device) if 'filter-r' in mode else None
+        f_scores = get_filter_scores(f_w[None], None if f_g is None else f_g[None], mode, gamma=self.gamma, r=r,
+                                     gm_approx=self.gm_approx, gm_eps=self.gm_eps)
         n_prune = int(round(n_f * (1.0 - prune_rate)))
-        prune_indices = np.sort(rank_indices[:n_prune])
+        prune_indices = get_prune_indices(f_scores, [n_prune])[0]
         self.logger.log(f'{name:10} Prune-F-Indices : {prune_indices}')
         return prune_indices
 
+    def _get_batched_filter_scores(self, mode='filter-a', names=None):
+        """
+        # Scores of the filters of every conv layer (or of the layers in "names"), the layers with identical weight
+        # shapes are stacked and scored by one batched call
+        # returns [(positions of the layers, (n_l, n_f) scores)] for every weight shape
+        """
+        convs = [(name, module) for name, module in self.model.named_modules() if isinstance(module, nn.Conv2d)]
+        groups = defaultdict(list)  # Weight shape => Positions of the layers
+        for i, (name, module) in enumerate(convs):
+            if names is None or name in names:
+                groups[tuple(module.weight.shape)].append(i)
+        rs = None
+        if 'filter-r' in mode:  # Draw in the order of the layers
+            rs = {i: np.random.rand(module.weight.shape[0]) for i, (name, module) in enumerate(convs)
+                  if names is None or name in names}
+
+        scores = list()
+        for shape, ids in groups.items():
+            ws, gs = zip(*[self._get_weight_and_grad(*convs[i]) for i in ids])
+            f_w = torch.stack(ws)
+            f_g = None if gs[0] is None else torch.stack(gs)
+            r = None if rs is None else torch.from_numpy(np.stack([rs[i] for i in ids])).to(f_w.device)
+            scores.append((ids, get_filter_scores(f_w, f_g, mode, gamma=self.gamma, r=r, gm_approx=self.gm_approx,
+                                                  gm_eps=self.gm_eps)))
+        return scores
+
+    def _get_batched_prune_indices(self, prune_rates, mode='filter-a', names=None):
+        """
+        # Same as calling "_get_prune_indices" on every conv layer (or on the layers in "names"), but the layers with
+        # identical weight shapes are stacked and scored by one batched call. The indices are not logged
+        """
+        convs = [(name, module) for name, module in self.model.named_modules() if isinstance(module, nn.Conv2d)]
+        prune_indices = dict()
+        for ids, f_scores in self._get_batched_filter_scores(mode=mode, names=names):
+            n_prunes = [int(round(f_scores.shape[1] * (1.0 - prune_rates[i]))) for i in ids]
+            for i, indices in zip(ids, get_prune_indices(f_scores, n_prunes)):
+                prune_indices[convs[i][0]] = indices
+        return prune_indices
+
+    def _get_group_prune_indices(self, prune_rates, mode='filter-a'):
+        """
+        # Prune indices selected per coupled channel group of "self.graph", so that the filters whose channels are
+        # summed by a residual addition are pruned together. The indices are not logged
+        """
+        convs = [name for name, module in self.model.named_modules() if isinstance(module, nn.Conv2d)]
+        f_scores = dict()
+        for ids, scores in self._get_batched_filter_scores(mode=mode):
+            for i, s in zip(ids, scores):
+                f_scores[convs[i]] = s
+        return self.graph.get_group_prune_indices(f_scores, dict(zip(convs, prune_rates)))
+
+    def _is_stable(self, name, module, prune_rate, mode):
+        """
+        # Whether the weights of the layer moved less than "rescore_threshold" (relative L2 distance) since its last
+        # scoring, in which case its previous prune indices are kept. Only for the modes depending on the weights only
+        """
+        if self.rescore_threshold is None or name not in self.score_weights:
+            return False
+        if 'filter-r' in mode or self._get_use_grad() or self.score_rates[name] != prune_rate:
+            return False
+        w0 = self.score_weights[name]
+        moved = torch.norm(module.weight.data - w0) / torch.clamp(torch.norm(w0), min=1e-12)
+        return moved.item() < self.rescore_threshold
+
+    def _set_score_history(self, name, module, prune_rate):
+        # Recorded after the filters are zeroed, so that a layer left untouched by the training is stable
+        if self.rescore_threshold is not None:
+            self.score_weights[name] = module.weight.data.clone()
+            self.score_rates[name] = prune_rate
+
+    def get_churn_stats(self):
+        """
+        Statistics of the last pruning:
+            churn    : Layer name => Number of filters whose prune status changed since the previous pruning
+            rescored : Names of the layers which were scored again (the others kept their prune indices)
+        """
+        return self.churn_stats
+
     @staticmethod
     def _prune_by_threshold(module, threshold):
-        weight = module.weight
-        tensor = weight.data.cpu().numpy()
-        mask = np.where(abs(tensor) < threshold, 0, 1)
-        weight.data = torch.from_numpy(tensor * mask).to(weight.device)
+        weight = module.weight.data
+        weight.masked_fill_(torch.abs(weight) < threshold, 0.)  # In place, on the device of the weight
 
     @staticmethod
     def _prune_by_indices(module, indices, dim=0, prune_weight=True, prune_bias=True, prune_grad=True):
@@ -134,26 +209,56 @@ class FiltersPruner(object):
             prune_rates *= i
         return prune_rates
 
-    def _prune_by_percentile(self, prune_rates):
-        i = 0
-        for name, module in self.model.named_modules():
-            if isinstance(module, torch.nn.Conv2d):
-                tensor = module.weight.data.cpu().numpy()
-                alive = tensor[np.nonzero(tensor)]  # Flattened array of nonzero values
-                percentile_value = np.percentile(abs(alive), prune_rates[i])
-                print(f'Pruning {name} with threshold : {percentile_value}')
-                self._prune_by_threshold(module, percentile_value)
-                i += 1
+    @staticmethod
+    def _get_percentile(x, q):
+        """
+        # Same as np.percentile(x, q) with the linear interpolation, x is a 1-D tensor.
+        # Use kthvalue for the 2 nearest ranks instead of sorting x
+        """
+        pos = q / 100. * (x.numel() - 1)
+        lo = int(math.floor(pos))
+        hi = min(lo + 1, x.numel() - 1)
+        v_lo = torch.kthvalue(x, lo + 1).values.item()
+        v_hi = torch.kthvalue(x, hi + 1).values.item() if hi != lo else v_lo
+        return v_lo + (pos - lo) * (v_hi - v_lo)
+
+    def _prune_by_percentile(self, prune_rates, mode='weight'):
+        """
+        # Unstructured pruning of the weights of the conv layers whose magnitude is under the "prune_rates[i]"
+        # percentile of the nonzero weights of layer i, or, if "global" in mode, under the "prune_rates[0]"
+        # percentile of the nonzero weights of all conv layers
+        """
+        convs = [(name, module) for name, module in self.model.named_modules() if isinstance(module, nn.Conv2d)]
+        if 'global' in mode:
+            alive = torch.cat([torch.abs(m.weight.data[m.weight.data != 0]).to(self.device) for _, m in convs])
+            thresholds = [self._get_percentile(alive, prune_rates[0]) if alive.numel() > 0 else 0.] * len(convs)
+        else:
+            thresholds = list()
+            for i, (name, module) in enumerate(convs):
+                weight = module.weight.data
+                alive = torch.abs(weight[weight != 0])  # Flattened tensor of nonzero values
+                thresholds.append(self._get_percentile(alive, prune_rates[i]) if alive.numel() > 0 else 0.)
+        n_pruned = n_total = 0
+        for (name, module), threshold in zip(convs, thresholds):
+            self._prune_by_threshold(module, threshold)
+            n_zeros = torch.sum(module.weight.data == 0).item()
+            n_pruned += n_zeros
+            n_total += module.weight.numel()
+            self.logger.log(f'{name:10} Pruning with threshold : {threshold} | zeros : {n_zeros}')
+        self.logger.log(f'Pruned {n_pruned} / {n_total} ({100 * n_pruned / n_total:6.2f}%) conv weights', verbose=True)
 
     def _init_conv_mask(self, name, module):
-        self.conv_mask[name] = torch.ones(module.weight.data.shape).to(self.device)
+        n_f, n_c = module.weight.shape[0:2]
+        self.conv_shape[name] = module.weight.shape
+        self.filter_mask[name] = torch.ones(n_f, dtype=torch.bool, device=self.device)
+        self.channel_mask[name] = torch.ones(n_c, dtype=torch.bool, device=self.device)
 
     def _set_conv_mask(self, name, prune_indices, dim=0):
-        mask_arr = self.conv_mask[name]
+        prune_indices = torch.as_tensor(prune_indices, dtype=torch.long, device=self.device)
         if dim == 0:
-            mask_arr[prune_indices] = 0
+            self.filter_mask[name][prune_indices] = False
         elif dim == 1:
-            mask_arr[:, prune_indices] = 0
+            self.channel_mask[name][prune_indices] = False
 
     def _get_use_grad(self):
         return self.use_grad
@@ -182,6 +287,56 @@ class FiltersPruner(object):
             p.grad.data = grad
         self.model = self.model.to(self.device)
 
+    def _next_samp_batch(self):
+        if self.samp_iter is None:
+            self.samp_iter = iter(self.train_loader)
+        try:
+            return next(self.samp_iter)
+        except StopIteration:  # Restart a new epoch of "train_loader"
+            self.samp_iter = iter(self.train_loader)
+            return next(self.samp_iter)
+
+    def _stream_batches_weight_grad(self):
+        """
+        # Same gradients as "_set_batches_weight_grad" (up to float rounding) but computed on "device" and without
+        # concatenating "samp_batches" batches into one input
+        # ----------------------------------------------------------
+        # The summed losses of the chunks are backwarded one after another, the gradients are accumulated by autograd
+        # and divided by the total number of samples at the end. Batches are merged into one chunk as long as the
+        # chunk stays under "max_stream_bytes" (one batch per chunk by default).
+        # NOTE: BatchNorm2d in train mode normalizes with the statistics of each chunk instead of those of the
+        # concatenated input, the gradients are identical if the model is in eval mode or the chunk holds all batches
+        # ----------------------------------------------------------
+        """
+        n_batches = self.samp_batches if self.samp_batches is not None else len(self.train_loader)
+        max_bytes = self.max_stream_bytes if self.max_stream_bytes is not None else 0
+        self.optimizer.zero_grad()
+
+        def backward_chunk(inputs, targets):
+            logit = self.model(torch.cat(inputs, dim=0))
+            loss = self.cross_entropy_sum(logit, torch.cat(targets, dim=0))
+            loss.backward()
+
+        n_samples = 0
+        inputs, targets = list(), list()
+        chunk_bytes = 0
+        for _ in range(n_batches):
+            inp, tar = [t.to(self.device) for t in self._next_samp_batch()]
+            inp_bytes = inp.element_size() * inp.nelement()
+            if inputs and chunk_bytes + inp_bytes > max_bytes:
+                backward_chunk(inputs, targets)
+                inputs, targets = list(), list()
+                chunk_bytes = 0
+            inputs.append(inp)
+            targets.append(tar)
+            chunk_bytes += inp_bytes
+            n_samples += len(tar)
+        backward_chunk(inputs, targets)
+
+        for p in self.model.parameters():
+            if p.grad is not None:
+                p.grad.data /= n_samples
+
     def _prune_filters_and_channels(self, prune_rates, mode='filter-norm'):
         """
         # We imitate FPGM (CVPR - 2019 oral) and don’t have prune channels
@@ -191,29 +346,70 @@ class FiltersPruner(object):
         dim = 0
         prune_indices = prune_indices_ = None
         if self._get_use_grad():
-            self._set_batches_weight_grad()
+            if self._use_saliency():
+                pass  # No extra pass over sampled batches
+            elif self.stream_grad:
+                self._stream_batches_weight_grad()
+            else:
+                self._set_batches_weight_grad()
+        convs = [(name, module) for name, module in self.model.named_modules() if isinstance(module, nn.Conv2d)]
+        batched_prune_indices = None
+        rescored = list()
+        if self.graph is not None:  # All layers of a group are rescored together, layer by layer greedy is not used
+            rescored = [name for name, _ in convs]
+            batched_prune_indices = self._get_group_prune_indices(prune_rates, mode=mode)
+        elif not self.use_greedy:
+            rescored = [name for j, (name, module) in enumerate(convs)
+                        if not self._is_stable(name, module, prune_rates[j], mode)]
+            batched_prune_indices = self._get_batched_prune_indices(prune_rates, mode=mode, names=set(rescored))
+        churn = dict()
         for name, module in self.model.named_modules():
             if isinstance(module, torch.nn.Conv2d):
                 self._init_conv_mask(name, module)
-                if not self.use_greedy:
-                    prune_indices_ = self._get_prune_indices(name, module, prune_rates[i], mode=mode)
+                if batched_prune_indices is not None:
+                    if name in batched_prune_indices:
+                        prune_indices_ = batched_prune_indices[name]
+                    else:
+                        prune_indices_ = self.prune_history[name]
+                    self.logger.log(f'{name:10} Prune-F-Indices : {prune_indices_}')
                 if dim == 1:
                     # self._prune_by_indices(module, prune_indices, dim=dim)
                     # self._set_conv_mask(name, prune_indices, dim=dim)
                     dim = 0
-                if self.use_greedy:
-                    prune_indices = self._get_prune_indices(name, module, prune_rates[i], mode=mode)
+                if batched_prune_indices is None:
+                    if self._is_stable(name, module, prune_rates[i], mode):
+                        prune_indices = self.prune_history[name]
+                        self.logger.log(f'{name:10} Prune-F-Indices : {prune_indices}')
+                    else:
+                        prune_indices = self._get_prune_indices(name, module, prune_rates[i], mode=mode)
+                        rescored.append(name)
                 else:
                     prune_indices = prune_indices_
+                if name in self.prune_history:
+                    churn[name] = len(np.setxor1d(self.prune_history[name], prune_indices))
+                self.prune_history[name] = prune_indices
                 self._prune_by_indices(module, prune_indices, dim=dim)
                 self._set_conv_mask(name, prune_indices, dim=dim)
+                if name in rescored:
+                    self._set_score_history(name, module, prune_rates[i])
                 dim = 1
                 i += 1
             elif isinstance(module, torch.nn.BatchNorm2d):
                 if 'filter' in mode and dim == 1:
                     self._prune_by_indices(module, prune_indices, dim=0)
         if self._get_use_grad():
-            self.optimizer.zero_grad()
+            if self._use_saliency():
+                self.saliency.on_pruned()
+            else:
+                self.optimizer.zero_grad()
+
+        self.churn_stats = {'churn': churn, 'rescored': rescored}
+        if churn:
+            n_changed = sum(churn.values())
+            n_filters = sum(module.weight.shape[0] for name, module in convs if name in churn)
+            self.logger.log(f'Mask churn : {n_changed} / {n_filters} filters changed '
+                            f'({100 * n_changed / n_filters:6.2f}%) | rescored {len(rescored)} / {len(convs)} layers',
+                            verbose=True)
 
     def _get_actual_prune_rates(self, prune_rates, verbose=False):
         """
@@ -259,18 +455,60 @@ class FiltersPruner(object):
         d = dict()
         for name, param in model.state_dict().items():
             if len(param.shape) == 4:  # Only consider conv layers
-                w = param.data.cpu().numpy()
-                trans_w = np.transpose(w, (1, 0, 2, 3))
-                sum_f = np.sum(w.reshape(w.shape[0], -1), axis=1)
-                sum_c = np.sum(trans_w.reshape(trans_w.shape[0], -1), axis=1)
-                left_f_ind = np.where(sum_f != 0)[0]  # Indices of the left filters
-                left_c_ind = np.where(sum_c != 0)[0]  # Indices of the left channels
-                left_w = w[left_f_ind[:, None], left_c_ind]
-                d[name] = (np.float32(left_w), np.int32(left_f_ind), np.int32(left_c_ind))
+                d[name] = FiltersPruner.get_left(param.data.cpu().numpy())
         return d
 
+    @staticmethod
+    def get_left(w):
+        """ Weights of the left filters / channels of the conv weight "w" (numpy), and their indices """
+        trans_w = np.transpose(w, (1, 0, 2, 3))
+        sum_f = np.sum(w.reshape(w.shape[0], -1), axis=1)
+        sum_c = np.sum(trans_w.reshape(trans_w.shape[0], -1), axis=1)
+        left_f_ind = np.where(sum_f != 0)[0]  # Indices of the left filters
+        left_c_ind = np.where(sum_c != 0)[0]  # Indices of the left channels
+        left_w = w[left_f_ind[:, None], left_c_ind]
+        return np.float32(left_w), np.int32(left_f_ind), np.int32(left_c_ind)
+
+    def get_filter_mask(self):
+        return self.filter_mask
+
+    def get_channel_mask(self):
+        return self.channel_mask
+
+    def get_grad_masks(self):
+        """
+        # Weights having pruned filters (or channels) and their compact float masks, (n_f, 1, 1, 1) or
+        # (n_f, n_c, 1, 1). Computed once after pruning and applied by "mask_grads" at every step
+        """
+        weights = list()
+        factors = list()
+        for name, module in self.model.named_modules():
+            if name not in self.filter_mask:
+                continue
+            f_mask, c_mask = self.filter_mask[name], self.channel_mask[name]
+            if bool(torch.all(c_mask)):
+                mask = f_mask[:, None]
+            else:
+                mask = f_mask[:, None] & c_mask[None, :]
+            if not bool(torch.all(mask)):
+                weights.append(module.weight)
+                factors.append(mask.to(module.weight.dtype)[:, :, None, None])
+        return weights, factors
+
+    @staticmethod
+    def mask_grads(weights, factors):
+        if weights:
+            torch._foreach_mul_([w.grad for w in weights], factors)  # In-place, broadcast over the kernel dims
+
     def get_conv_mask(self):
-        return self.conv_mask
+        """
+        Dense float masks with the shapes of the conv weights, built from the boolean filter / channel masks
+        """
+        d = dict()
+        for name, f_mask in self.filter_mask.items():
+            mask = f_mask[:, None] & self.channel_mask[name][None, :]
+            d[name] = mask.float()[:, :, None, None].expand(self.conv_shape[name]).contiguous()
+        return d
 
     def prune(self, mode, prune_rates):
         prune_rates = self._check_prune_rates(prune_rates)
@@ -281,11 +519,48 @@ class FiltersPruner(object):
             self._set_use_grad(val='-g-' in mode)
             self._prune_filters_and_channels(prune_rates, mode=mode)
         else:
-            self._prune_by_percentile(prune_rates)
-
-
-
-
+            self._prune_by_percentile(prune_rates, mode=mode)
+
+
+class GradSaliency(object):
+    """
+    Per-element |gradient| statistic of the conv weights, accumulated on device at every training step, so that the
+    "-g-" prune modes need no extra forward/backward pass over sampled batches.
+    ----------------------------------------------------------
+    momentum=None : Mean of |grad| over the steps since the last pruning
+    momentum=m    : EMA of |grad|, i.e. stat = m * stat + (1 - m) * |grad|, kept across prunings
+    ----------------------------------------------------------
+    """
+    def __init__(self, model, momentum=None):
+        super(GradSaliency, self).__init__()
+        convs = [(name, module) for name, module in model.named_modules() if isinstance(module, nn.Conv2d)]
+        self.indices = {name: i for i, (name, _) in enumerate(convs)}
+        self.weights = [module.weight for _, module in convs]
+        self.momentum = momentum
+        self.stats = None
+        self.n_steps = 0
+
+    @torch.no_grad()
+    def update(self):
+        """ Call after the backward pass of every training step """
+        abs_grads = torch._foreach_abs([w.grad for w in self.weights])
+        if self.stats is None:
+            self.stats = abs_grads
+        elif self.momentum is None:
+            torch._foreach_add_(self.stats, abs_grads)
+        else:
+            torch._foreach_mul_(self.stats, self.momentum)
+            torch._foreach_add_(self.stats, abs_grads, alpha=1 - self.momentum)
+        self.n_steps += 1
 
+    def is_ready(self):
+        return self.n_steps > 0
 
+    def get(self, name):
+        stat = self.stats[self.indices[name]]
+        return stat / self.n_steps if self.momentum is None else stat
 
+    def on_pruned(self):
+        if self.momentum is None:  # Restart the mean
+            self.stats = None
+            self.n_steps = 0
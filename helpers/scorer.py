@@ -0,0 +1,170 @@
+import math
+
+import numpy as np
+
+import torch
+
+
+def get_exact_gm_dists(w):
+    """
+    Sum of the squared euclidean distances between each filter and all the filters of the layer
+    --------------------------------------------
+    Shape of w : (n_f, n_c * h * w) or (n_l, n_f, n_c * h * w) for n_l layers of the same shape
+    --------------------------------------------
+    # sum_j ||w_i - w_j||^2 = n_f * ||w_i||^2 + sum_j ||w_j||^2 - 2 * <w_i, sum_j w_j> (the distances to the centroid of
+    # the filters), an exact identity which costs O(n_f * d) instead of the O(n_f^2 * d) of the pairwise distances.
+    # It is computed in float64 and agrees with "get_pairwise_gm_dists" up to the rounding errors (about 1e-7)
+    """
+    if w.dim() == 2:
+        return get_exact_gm_dists(w[None])[0]
+    n_l, n_f = w.shape[0:2]
+    w64 = w.reshape(n_l, n_f, -1).double()
+    sq_norms = torch.einsum('lnd,lnd->ln', w64, w64)  # (n_l, n_f)
+    dots = torch.einsum('lnd,ld->ln', w64, torch.sum(w64, dim=1))  # (n_l, n_f)
+    dists = n_f * sq_norms + torch.sum(sq_norms, dim=1, keepdim=True) - 2. * dots
+    return dists.clamp_(min=0.).to(w.dtype)  # (n_l, n_f)
+
+
+def get_pairwise_gm_dists(w, chunk_elems=1 << 24):
+    """
+    Same as "get_exact_gm_dists" from the pairwise distances between the filters
+    --------------------------------------------
+    Shape of w : (n_f, n_c * h * w) or (n_l, n_f, n_c * h * w) for n_l layers of the same shape
+    --------------------------------------------
+    # Use ||a - b||^2 = ||a||^2 + ||b||^2 - 2 * <a, b> so that the pairwise distances are computed by a matmul
+    # (Gram matrix) instead of n_f broadcasts of (n_f, n_c * h * w). Rows are processed in chunks so that at most
+    # "chunk_elems" distances are alive at once.
+    """
+    if w.dim() == 2:
+        return get_pairwise_gm_dists(w[None], chunk_elems)[0]
+    n_l, n_f = w.shape[0:2]
+    w = w.reshape(n_l, n_f, -1)
+    sq_norms = torch.sum(w * w, dim=2)  # (n_l, n_f)
+    chunk = max(1, chunk_elems // max(n_l * n_f, 1))
+    dists = torch.empty(n_l, n_f, dtype=w.dtype, device=w.device)
+    for start in range(0, n_f, chunk):
+        end = min(start + chunk, n_f)
+        gram = torch.bmm(w[:, start:end], w.transpose(1, 2))  # (n_l, chunk, n_f)
+        d = sq_norms[:, start:end, None] + sq_norms[:, None, :] - 2. * gram
+        d.clamp_(min=0.)  # Remove the negative values caused by the rounding errors
+        rows = torch.arange(end - start, device=w.device)
+        d[:, rows, rows + start] = 0.  # The distance of a filter to itself is exactly 0
+        dists[:, start:end] = torch.sum(d, dim=2)
+    return dists  # (n_l, n_f)
+
+
+def get_sketch_dim(n_f, eps):
+    """ Johnson-Lindenstrauss dimension preserving all the pairwise squared distances of n_f points within 1 +- eps """
+    return int(math.ceil(4. * math.log(max(n_f, 2)) / (eps ** 2 / 2. - eps ** 3 / 3.)))
+
+
+def is_sketch_cheaper(n_f, d, eps):
+    """
+    Whether projecting the n_f filters of d weights onto "get_sketch_dim(n_f, eps)" dims (n_f * d * k) and computing
+    their pairwise distances (n_f^2 * k) costs less than the pairwise distances of the filters (n_f^2 * d)
+    """
+    k = get_sketch_dim(n_f, eps)
+    return k < n_f and n_f * d * k + n_f * n_f * k < n_f * n_f * d
+
+
+def get_approx_gm_dists(w, method='sketch', eps=0.3, seed=0):
+    """
+    Alternatives of "get_exact_gm_dists"
+    --------------------------------------------
+    Shape of w : (n_l, n_f, n_c * h * w)
+    --------------------------------------------
+    # method:
+    #    centroid : "get_exact_gm_dists" itself (the closed form through the centroid of the filters), kept as a name
+    #    sketch   : Pairwise distances of the random projections of the filters onto "get_sketch_dim(n_f, eps)" dims,
+    #               every distance (thus every score) is within 1 +- eps of the exact one with high probability. The
+    #               exact distances are returned when the sketch is not cheaper than the pairwise distances
+    #               ("is_sketch_cheaper"). The projection alone (n_f * d * k) costs more than the closed form of
+    #               "get_exact_gm_dists" (n_f * d), which stays the fastest for every layer
+    """
+    n_l, n_f = w.shape[0:2]
+    w = w.reshape(n_l, n_f, -1)
+    if method == 'centroid':
+        return get_exact_gm_dists(w)
+    elif method == 'sketch':
+        if not is_sketch_cheaper(n_f, w.shape[2], eps):
+            return get_exact_gm_dists(w)
+        k = get_sketch_dim(n_f, eps)
+        generator = torch.Generator(device=w.device).manual_seed(seed)
+        proj = torch.randn(w.shape[2], k, generator=generator, device=w.device, dtype=w.dtype) / math.sqrt(k)
+        return get_pairwise_gm_dists(torch.matmul(w, proj))
+    raise NameError(method)
+
+
+def min_max_scalar(x, dim):
+    x_min = torch.amin(x, dim=dim, keepdim=True)
+    x_max = torch.amax(x, dim=dim, keepdim=True)
+    return (x - x_min) / (x_max - x_min)
+
+
+def get_filter_scores(w, g, mode, gamma=0.5, r=None, gm_approx=None, gm_eps=0.3):
+    """
+    Scores of the filters of n_l layers of the same shape, the filters with the lowest scores are pruned
+    --------------------------------------------
+    Shape of w, g : (n_l, n_f, n_c * h * w), the weights and the gradients of the filters
+    Shape of r : (n_l, n_f), the random scores for "filter-r"
+    gm_approx : None (exact) or the "method" of "get_approx_gm_dists" for the GM distances
+    --------------------------------------------
+    # In mode:
+    #    -g- : Combine gradients
+    #    -n- : Combine min-max-scalar
+    #    -a  : Use activation-base
+    #    -gm : Use geometric-median-base
+    """
+    def get_l1_scores(arr):
+        return torch.sum(torch.abs(arr), dim=2)  # (n_l, n_f)
+
+    def get_gm_dists(arr):
+        if gm_approx is None:
+            return get_exact_gm_dists(arr)
+        return get_approx_gm_dists(arr, method=gm_approx, eps=gm_eps)
+
+    if 'filter-a' in mode:
+        f_scores = get_l1_scores(w)
+    elif 'filter-g-a' in mode:
+        f_scores = torch.sum(torch.abs(w) * torch.abs(g), dim=2)
+    elif 'filter-n-g-a' in mode:
+        f_scores = torch.sum(min_max_scalar(torch.abs(w), (1, 2)) + min_max_scalar(torch.abs(g), (1, 2)), dim=2)
+    elif 'filter-n-g-a-2' in mode:
+        f_scores = min_max_scalar(get_l1_scores(w), 1) + min_max_scalar(get_l1_scores(g), 1)
+    elif 'filter-gm' in mode:
+        f_scores = get_gm_dists(w)
+    elif 'filter-g-gm-1' in mode:
+        f_scores = get_gm_dists(w) * get_l1_scores(g)
+    elif 'filter-g-gm-2' in mode:
+        f_scores = get_gm_dists(w) + get_l1_scores(g)
+    elif 'filter-g-gm-3' in mode:
+        f_scores = get_gm_dists(w) * get_l1_scores(g) * get_l1_scores(w)
+    elif 'filter-n-g-gm-1' in mode:
+        f_scores = (
+            gamma * min_max_scalar(get_gm_dists(w), 1) + (1 - gamma) * min_max_scalar(get_l1_scores(g), 1)
+        )
+    elif 'filter-n-g-gm-2' in mode:
+        f_scores = (min_max_scalar(get_gm_dists(w), 1) + min_max_scalar(get_l1_scores(g), 1) +
+                    min_max_scalar(get_l1_scores(w), 1))
+    elif 'filter-n-g-gm-3' in mode:
+        f_scores = min_max_scalar(get_gm_dists(w), 1) * min_max_scalar(get_l1_scores(g), 1)
+    elif 'filter-r' in mode:
+        f_scores = r
+    else:
+        raise NameError(mode)
+    return f_scores  # (n_l, n_f)
+
+
+def get_prune_indices(f_scores, n_prunes):
+    """
+    Indices of the "n_prunes[i]" lowest scores of every layer i
+    --------------------------------------------
+    Shape of f_scores : (n_l, n_f)
+    --------------------------------------------
+    # The selection is done for all layers at once: a filter is pruned if its rank (stable for ties) in its layer is
+    # lower than the number of filters to prune of the layer
+    """
+    n_prunes = torch.as_tensor(n_prunes, device=f_scores.device)
+    ranks = torch.argsort(torch.argsort(f_scores, dim=1, stable=True), dim=1)
+    is_pruned = (ranks < n_prunes[:, None]).cpu().numpy()
+    return [np.nonzero(m)[0] for m in is_pruned]  # Sorted indices
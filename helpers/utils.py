@@ -79,10 +79,6 @@ def z_score_v2(x):
     return (x - np.min(x)) / np.std(x)
 
 
-def min_max_scalar(x):
-    return (x - np.min(x)) / (np.max(x) - np.min(x))
-
-
 class Logger:
     def __init__(self, log_path):
         self.log_path = log_path
@@ -99,6 +95,22 @@ class Logger:
         self.log(line)
 
 
+class BufferLogger:
+    """ Keeps the logs (of a worker process) to be written later by "replay", in the same order """
+    def __init__(self):
+        self.records = list()
+
+    def log(self, text, verbose=False):
+        self.records.append((text, verbose))
+
+    def log_line(self):
+        self.log('\n' + '-' * 100)
+
+    def replay(self, logger):
+        for text, verbose in self.records:
+            logger.log(text, verbose=verbose)
+
+
 class AverageMeter:
     def __init__(self):
         self.n = 0
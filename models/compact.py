@@ -0,0 +1,52 @@
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class CompactBlock(nn.Module):
+    """
+    Residual block whose body only computes the filters left after pruning.
+    ----------------------------------------------------------
+    The residual stream only holds the channels which can be nonzero, so the input of a block (over "n_in" channels)
+    and its output (over "n_out" channels) may differ. The output of the shortcut is put at "res_idx" and the output
+    of the body is added at "body_idx" of the output stream.
+    ----------------------------------------------------------
+    """
+
+    def __init__(self, body, shortcut, res_idx, body_idx, n_out):
+        super(CompactBlock, self).__init__()
+        self.body = body
+        self.shortcut = shortcut
+        self.n_out = n_out
+        self.register_buffer('res_idx', res_idx)
+        self.register_buffer('body_idx', body_idx)
+        self.is_res_full = len(res_idx) == n_out  # Shortcut covers the whole output stream
+
+    def forward(self, x):
+        residual = x if self.shortcut is None else self.shortcut(x)
+        out = self.body(x)
+        if self.is_res_full:
+            out = residual.index_add(1, self.body_idx, out)
+        else:
+            size = (residual.size(0), self.n_out) + tuple(residual.shape[2:])
+            out = residual.new_zeros(size).index_copy_(1, self.res_idx, residual).index_add_(1, self.body_idx, out)
+        return F.relu(out, inplace=True)
+
+
+class CompactResNet(nn.Module):
+    """ ResNet rebuilt from a pruned "CifarResNet" or "ResNet" with the pruned filters physically removed """
+
+    def __init__(self, stem, blocks, avgpool, fc):
+        super(CompactResNet, self).__init__()
+        self.stem = stem
+        self.blocks = blocks
+        self.avgpool = avgpool
+        self.fc = fc
+
+    def forward(self, x):
+        x = self.stem(x)
+        x = self.blocks(x)
+        x = self.avgpool(x)
+        x = x.view(x.size(0), -1)
+        x = self.fc(x)
+        return x
+
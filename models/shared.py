@@ -0,0 +1,98 @@
+import sys
+
+import numpy as np
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class _SharedWeight(nn.Module):
+    """
+    Weight of a quantized layer kept as the table of its shared values and the index of every weight in the table.
+    ----------------------------------------------------------
+    "indices" is the cluster index of "PostQuantizer" into "centroids". If the layer has zero (pruned) weights, the
+    entry 0 of "centroids" is the zero weight and "indices" is the cluster index + 1. The indices are uint8 up to 256
+    entries, a quarter of the dense float32 weight, and int16 beyond, half of it (a pruned layer at 8 bits). The
+    dense weight is only gathered for the computation, "max_elems" weights (a chunk of the output channels) at a
+    time. On the CPU, the large chunks of uint8 indices are gathered two at a time from a table of the pairs of
+    centroids (8 x 256 bytes per centroid).
+    ----------------------------------------------------------
+    """
+    MIN_PAIR_GATHER = 1 << 16  # Chunks of uint8 indices from which the weights are gathered by pairs
+
+    def __init__(self, centroids, indices, bias, max_elems):
+        super(_SharedWeight, self).__init__()
+        self.register_buffer('centroids', centroids)
+        self.register_buffer('indices', indices)
+        self.bias = None if bias is None else nn.Parameter(bias, requires_grad=False)
+        self.chunk = max(1, max_elems // max(indices[0].numel(), 1))  # Output channels per chunk
+        self.pair_table = None  # Built at the first pair gather
+
+    @staticmethod
+    def get_table(weight, labels):
+        """ Centroids and indices of "weight" (numpy) from its cluster indices "labels" (-1 : zero weight) """
+        indices = labels.astype(np.int64)
+        if np.any(indices < 0):  # The entry 0 is the zero weight
+            indices += 1
+        centroids = np.zeros(int(np.max(indices, initial=0)) + 1, dtype=np.float32)
+        centroids[indices.reshape(-1)] = weight.reshape(-1)
+        if not np.array_equal(centroids[indices], weight):
+            raise ValueError('The weights are not shared by the cluster indices')
+        dtype = np.uint8 if len(centroids) <= 1 << 8 else np.int16
+        return torch.from_numpy(centroids), torch.from_numpy(indices.astype(dtype))
+
+    def get_weight(self, start=0, end=None):
+        """ Dense weights of the output channels [start, end) """
+        indices = self.indices[start:end]
+        if indices.device.type != 'cpu':
+            return self.centroids[indices.long()]
+        centroids, indices = self.centroids.numpy(), indices.numpy()
+        if indices.dtype != np.uint8 or indices.size % 2 or indices.size < self.MIN_PAIR_GATHER:
+            return torch.from_numpy(np.take(centroids, indices))
+        # Two weights per gather: the pairs of indices read as uint16 index the table of the pairs of centroids
+        if self.pair_table is None:
+            n = len(centroids)
+            padded = np.zeros(256, dtype=np.float32)
+            padded[:n] = centroids
+            table = np.empty((n, 256, 2), dtype=np.float32)  # [Byte of the highest weight, other byte]
+            first, second = (padded[None, :], centroids[:, None]) if sys.byteorder == 'little' else \
+                (centroids[:, None], padded[None, :])
+            table[:, :, 0], table[:, :, 1] = first, second
+            self.pair_table = table.reshape(-1).view(np.float64)
+        pairs = np.take(self.pair_table, indices.reshape(-1).view(np.uint16))
+        return torch.from_numpy(pairs.view(np.float32).reshape(indices.shape))
+
+    def _forward(self, x, fn):
+        n_out = self.indices.shape[0]
+        if self.chunk >= n_out:
+            return fn(x, self.get_weight(), self.bias)
+        outs = list()
+        for start in range(0, n_out, self.chunk):
+            end = min(start + self.chunk, n_out)
+            outs.append(fn(x, self.get_weight(start, end), None if self.bias is None else self.bias[start:end]))
+        return torch.cat(outs, dim=1)
+
+
+class SharedConv2d(_SharedWeight):
+    """ nn.Conv2d computed from the shared values of its weight (see "_SharedWeight") """
+    def __init__(self, conv, labels, max_elems=1 << 22):
+        centroids, indices = self.get_table(conv.weight.data.cpu().numpy(), labels)
+        bias = None if conv.bias is None else conv.bias.data.clone()
+        super(SharedConv2d, self).__init__(centroids, indices, bias, max_elems)
+        self.stride, self.padding, self.dilation, self.groups = conv.stride, conv.padding, conv.dilation, conv.groups
+        assert self.groups == 1, 'Grouped convolutions are not supported'
+
+    def forward(self, x):
+        return self._forward(x, lambda x, w, b: F.conv2d(x, w, b, self.stride, self.padding, self.dilation))
+
+
+class SharedLinear(_SharedWeight):
+    """ nn.Linear computed from the shared values of its weight (see "_SharedWeight") """
+    def __init__(self, fc, labels, max_elems=1 << 22):
+        centroids, indices = self.get_table(fc.weight.data.cpu().numpy(), labels)
+        bias = None if fc.bias is None else fc.bias.data.clone()
+        super(SharedLinear, self).__init__(centroids, indices, bias, max_elems)
+
+    def forward(self, x):
+        return self._forward(x, F.linear)
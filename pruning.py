@@ -16,7 +16,8 @@ from helpers.utils import (
 from helpers import dataset
 import models
 from helpers.trainer import Trainer
-from helpers.pruner import FiltersPruner
+from helpers.pruner import FiltersPruner, GradSaliency
+from helpers.exporter import CompactExporter
 from distillers_zoo import (
     LogitSimilarity,
     LogitSimilarity2,
@@ -53,6 +54,14 @@ parser.add_argument('--soft-prune', action='store_true', default=False)  # Do so
 parser.add_argument('--prune-rates', nargs='+', type=float, default=[1.0])  # No prune by default
 parser.add_argument('--samp-batches', type=int, default=None)  # Sample batches to compute gradient for pruning. Use
 # all batches by default
+parser.add_argument('--stream-grad', action='store_true', default=False)  # Accumulate the gradients for pruning
+# batch by batch on the device instead of one concatenated batch on CPU
+parser.add_argument('--stream-max-mb', type=float, default=None)  # Memory ceiling (MB) of the inputs of one streamed
+# forward/backward pass. One batch per pass by default
+parser.add_argument('--grad-saliency', action='store_true', default=False)  # Accumulate |grad| of the conv
+# weights during training and use it in the "-g-" prune modes instead of an extra pass over sampled batches
+parser.add_argument('--saliency-momentum', type=float, default=None)  # EMA momentum of "--grad-saliency". Use the
+# mean since the last pruning by default
 parser.add_argument('--use-actPR', action='store_true', default=False)  # Compute actual pruning rates for conv layers
 # or not
 parser.add_argument('--use-greedy', action='store_true', default=False)  # Prune filters by greedy or independent
@@ -69,12 +78,22 @@ parser.add_argument('--kd-t', type=float, default=4.0)  # Temperature for KL dis
 parser.add_argument('--alpha', type=float, default=0.9)  # For KL-divergence distillation
 parser.add_argument('--betas', nargs='+', type=float, default=[50.0])  # For custom-method distillation
 parser.add_argument('--gamma', type=float, default=0.5)  # For our filter pruning method "N-G-GM"
+parser.add_argument('--gm-approx', type=str, default=None)  # Other GM distances: "sketch" (random projections).
+# By default (or "centroid"), the exact distances are computed in closed form from the centroid of the filters
+parser.add_argument('--gm-eps', type=float, default=0.3)  # Error bound of the "sketch" GM distances, the layers
+# for which the sketch is not cheaper than the pairwise distances keep the exact distances
+parser.add_argument('--rescore-threshold', type=float, default=None)  # Keep the prune indices of a layer whose
+# weights moved less than this relative L2 distance since its last scoring (modes without gradients / randomness)
+parser.add_argument('--group-prune', action='store_true', default=False)  # Select the filters per group of
+# channels coupled by residual additions (traced by "DependencyGraph"), so that the pruned model can be shrunk
 parser.add_argument('--t-path', type=str, default=None)  # The .pt file path of teacher model
 parser.add_argument('--s-path', type=str, default=None)  # The .pt file path of student model
 parser.add_argument('--s-copy-t', action='store_true', default=False)  # During self-distillation, whether student
 # copy teacher during initialization
 parser.add_argument('--log-name', type=str, default='logs.txt')  # The name of the log file
 parser.add_argument('--dev-idx', type=int, default=0)  # The index of the used cuda device
+parser.add_argument('--export-compact', action='store_true', default=False)  # Physically remove the pruned filters
+# after training and save the compact model
 args = parser.parse_args()
 
 os.environ['KMP_DUPLICATE_LIB_OK'] = 'True'  # For Mac OS
@@ -105,6 +124,10 @@ class PrunedModelTrainer(Trainer):
             self.criterion_div = KLDistiller(self.args.kd_t)
             self.criterion_kd, self.is_group, self.is_block = self._init_kd(self.args.distill)
 
+        self.saliency = None
+        if self.args.grad_saliency:
+            self.saliency = GradSaliency(self.s_model, momentum=self.args.saliency_momentum)
+
         self.s_pruner = FiltersPruner(
             self.s_model,
             self.optimizer,
@@ -114,19 +137,24 @@ class PrunedModelTrainer(Trainer):
             samp_batches=self.args.samp_batches,
             device=self.device,
             use_actPR=self.args.use_actPR,
-            use_greedy=self.args.use_greedy
+            use_greedy=self.args.use_greedy,
+            stream_grad=self.args.stream_grad,
+            max_stream_bytes=None if self.args.stream_max_mb is None else int(self.args.stream_max_mb * 2 ** 20),
+            saliency=self.saliency,
+            gm_approx=self.args.gm_approx,
+            gm_eps=self.args.gm_eps,
+            rescore_threshold=self.args.rescore_threshold,
+            group_prune=self.args.group_prune
         )
         self.last_epoch = None
+        self.mask_weights = list()
+        self.mask_factors = list()
 
         self.t_model.eval()
         self.t_model = self.t_model.to(self.device)
 
     def _mask_pruned_filters_grad(self):
-        conv_mask = self.s_pruner.get_conv_mask()
-        for name, module in self.s_model.named_modules():
-            if name in conv_mask:
-                grad = module.weight.grad
-                grad.data *= conv_mask[name]
+        FiltersPruner.mask_grads(self.mask_weights, self.mask_factors)
 
     def _init_kd(self, method):
         is_group = False
@@ -225,6 +253,9 @@ class PrunedModelTrainer(Trainer):
             loss = loss_cls
         loss.backward()
 
+        if self.saliency is not None:
+            self.saliency.update()
+
         # Set the gradient of the pruned weights to 0 if it's in the "hard prune mode"
         if self.do_hard_prune:
             self._mask_pruned_filters_grad()
@@ -255,8 +286,20 @@ class PrunedModelTrainer(Trainer):
         if not (do_prune and self.cur_epoch % self.args.prune_interval == 0):
             return
         self.s_pruner.prune(self.args.prune_mode, self.args.prune_rates)
+        if self.do_hard_prune:
+            self.mask_weights, self.mask_factors = self.s_pruner.get_grad_masks()
         print_nonzeros(self.s_model)
 
+    def export_compact(self):
+        exporter = CompactExporter(self.logger)
+        conv_mask = self.s_pruner.get_conv_mask() or None
+        compact_model = exporter.export(self.s_model, conv_mask)
+        input = next(iter(self.eval_loader))[0].to(self.device)
+        exporter.check_parity(self.s_model, compact_model, input, conv_mask)
+        file_path = os.path.join(self.save_dir, 'model_compact.pt')
+        self.logger.log(f'Saving the compact model to {file_path}', verbose=True)
+        torch.save(compact_model, file_path)
+
     def _plot_feat(self, method):
         if method == 'msp':
             plotter = MultiSimilarityPlotter()
@@ -321,6 +364,8 @@ def main():
     else:
         trainer.train()
         trainer.eval()
+    if args.export_compact:
+        trainer.export_compact()
 
 
 if __name__ == '__main__':
@@ -1,7 +1,6 @@
 import argparse
 import os
 import time
-import numpy as np
 
 from helpers.utils import (
     check_dirs_exist,
@@ -14,11 +13,10 @@ from helpers.utils import (
 from helpers import dataset
 import models
 from helpers.trainer import Trainer
-from helpers.quantizer import PostQuantizer
+from helpers.quantizer import PostQuantizer, BitAllocator
 from helpers.encoder import HuffmanEncoder
 
 from tensorboardX import SummaryWriter
-import torch
 import torch.optim as optim
 import torch.nn as nn
 
@@ -31,11 +29,21 @@ parser.add_argument('--model', type=str, default='resnet56')
 parser.add_argument('--dataset', type=str, default='cifar10')
 parser.add_argument('--load-path', type=str, default='None')
 parser.add_argument('--quan-mode', type=str, default='all-quan')  # pattern: "(all|conv|fc)-quan"
-parser.add_argument('--quan-bits', type=int, default='None')
+parser.add_argument('--quan-bits', type=int, default=None)
+parser.add_argument('--size-budget', type=float, default=None)  # Bytes of the encoded model, the bits of every layer
+# are searched among "--bit-candidates" (instead of "--quan-bits") by their sensitivities on "--calib-batches" batches
+parser.add_argument('--bit-candidates', type=int, nargs='+', default=[2, 3, 4, 5, 6, 7, 8])
+parser.add_argument('--calib-batches', type=int, default=4)
+parser.add_argument('--quan-workers', type=int, default=1)  # Processes clustering the layers
 parser.add_argument('--schedule', type=int, nargs='+', default=[50, 100, 150])
 parser.add_argument('--lr-drops', type=float, nargs='+', default=[0.1, 0.1, 0.1])
 parser.add_argument('--momentum', default=0.9, type=float)
 parser.add_argument('--weight-decay', default=5e-4, type=float)
+parser.add_argument('--encode-backend', type=str, default='files')  # "files" (one file per array) or "container"
+# (a single indexed file, memory-mapped when decoding)
+parser.add_argument('--huffman-codebook', type=str, default='canonical')  # "canonical" (code lengths only) or "tree"
+parser.add_argument('--encode-workers', type=int, default=1)  # Processes encoding / decoding the layers
+parser.add_argument('--entropy-coders', type=str, nargs='+', default=['huffman', 'rans'])  # The smallest is kept
 parser.add_argument('--dev-idx', type=int, default=0)  # The index of the used cuda device
 parser.add_argument('--log-name', type=str, default='logs.txt')  # The name of the log file
 args = parser.parse_args()
@@ -53,40 +61,23 @@ class QuantizedModelTrainer(Trainer):
         self.writer = writer
         self.cross_entropy = nn.CrossEntropyLoss()
 
-        quantizer = PostQuantizer(self.args.quan_mode, device=self.device)
-        quantizer.quantize(self.model, self.args.quan_bits)
+        quantizer = PostQuantizer(self.args.quan_mode, device=self.device, n_workers=self.args.quan_workers)
+        bits = self.args.quan_bits
+        if self.args.size_budget is not None:
+            encoder = HuffmanEncoder(self.logger, canonical=self.args.huffman_codebook == 'canonical',
+                                     coders=self.args.entropy_coders)
+            allocator = BitAllocator(quantizer, encoder, self.logger, self.args.bit_candidates)
+            batches = BitAllocator.get_calib_batches(self.train_loader, self.args.calib_batches, self.device)
+            bits = allocator.search(self.model, batches, self.args.size_budget)
+        quantizer.quantize(self.model, bits)
         self.quan_dict = quantizer.get_quan_dict()
 
-        self.mask = dict()
+        self.grad_groups = None  # Built at the first step, see "PostQuantizer.get_grad_groups"
 
     def _set_quan_weight_grad(self):
-        for name, module in self.model.named_modules():
-            if name in self.quan_dict:
-                if name not in self.mask:
-                    self.mask[name] = dict()
-                mask = self.mask[name]
-                weight = module.weight.data.cpu().numpy()
-                grad = module.weight.grad.data.cpu().numpy()
-
-                # Mask gradients of pruend weights
-                key = 'grad'
-                if key not in mask:
-                    mask[key] = np.where(weight == 0, 0, 1)
-                grad *= mask[key]
-
-                # Set gradients of quantized weights
-                quan_labels = self.quan_dict[name]
-                quan_range = len(np.unique(quan_labels))
-                key = 'ind'
-                if key not in mask:
-                    mask[key] = dict()
-                for i in range(quan_range):
-                    if i not in mask[key]:
-                        mask[key][i] = np.where(quan_labels == i)
-                    group_ind = mask[key][i]
-                    group_grad_sum = np.sum(grad[group_ind])
-                    grad[group_ind] = group_grad_sum
-                module.weight.grad.data = torch.from_numpy(grad).to(self.device)
+        if self.grad_groups is None:
+            self.grad_groups = PostQuantizer.get_grad_groups(self.model, self.quan_dict)
+        PostQuantizer.share_grads(self.grad_groups)
 
     def _get_loss_and_backward(self, batch):
         input, target = batch
@@ -159,10 +150,14 @@ def main():
     base_cfg = (args, enc_model, None, eval_loader, None, args.save_dir, device, logger)
     evaluator = Evaluator(*base_cfg)
     evaluator.eval()
-    encoder = HuffmanEncoder(logger)
-    encoder.huffman_encode_model(enc_model)
+    encoder = HuffmanEncoder(logger, canonical=args.huffman_codebook == 'canonical', n_workers=args.encode_workers,
+                             coders=args.entropy_coders)
+    _, sizes = encoder.huffman_encode_model(enc_model, backend=args.encode_backend, quan_dict=trainer.quan_dict)
+    if args.size_budget is not None and sizes['Total'][1] > args.size_budget:  # e.g. the retrained entries grew
+        logger.log(f"The encoded model ({sizes['Total'][1]} bytes) is over the size budget ({int(args.size_budget)} "
+                   f"bytes)", verbose=True)
     dec_model = models.__dict__[args.model](num_classes=num_classes)
-    encoder.huffman_decode_model(dec_model)
+    encoder.huffman_decode_model(dec_model, backend=args.encode_backend)
     base_cfg = (args, dec_model, None, eval_loader, None, args.save_dir, device, logger)
     evaluator = Evaluator(*base_cfg)
     evaluator.eval()
@@ -0,0 +1,22 @@
+#!/usr/bin/env bash
+# Per-step overhead of masking the gradients of the pruned filters
+python3 benchmark.py --task mask-grad --models resnet56 resnet50
+
+# Speedup and pruned-filter agreement of the closed-form and the sketched GM distances
+python3 benchmark.py --task gm-approx --gm-eps 0.3
+
+# Throughput (symbols/s) of the table driven Huffman decoder against the former bit string decoder
+python3 benchmark.py --task huffman-decode --n-iters 3 --n-symbols 100000 1000000 4000000
+
+# Compression ratio and encode / decode throughput (MB/s of dense weights) of the entropy coders on quantized models
+# (pruned by magnitude and rounded to 16 levels, or the models of "quantize_encode.py" with --load-paths)
+python3 benchmark.py --task entropy-coders --models resnet56 resnet50 --n-iters 1 --zero-rate 0.7
+
+# Error and speedup of the compressed size estimator against the encoder
+python3 benchmark.py --task size-estimate --models resnet56 resnet50 --n-iters 1 --zero-rate 0.7
+
+# Per-step overhead of sharing the gradients of the quantized layers (on device against the former numpy loop)
+python3 benchmark.py --task quan-grad --models resnet56 resnet50 --n-iters 20
+
+# CPU latency and memory of the quantized models computed from their shared values (uint8 indices + centroids)
+python3 benchmark.py --task lut-inference --models resnet56 alexnet --n-iters 20 --batch-sizes 1 32
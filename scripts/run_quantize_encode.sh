@@ -1,2 +1,5 @@
 #!/usr/bin/env bash
 python3 quantize_encode.py --model resnet56 --dataset cifar10 --n-epochs 20 --lr 0.001 --quan-mode conv-quan --load-path saves/resnet56_cifar10/initial_train/model_epochs_163.pt --quan-bits 5
+
+# Bit widths searched per layer (among --bit-candidates) for the encoded model to fit in --size-budget bytes
+python3 quantize_encode.py --model resnet56 --dataset cifar10 --n-epochs 20 --lr 0.001 --quan-mode conv-quan --load-path saves/resnet56_cifar10/initial_train/model_epochs_163.pt --size-budget 200000 --bit-candidates 2 3 4 5 6 --calib-batches 4